@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#
+#  Benchmarks for timetracker
+#
+help_text = """
+Generate synthetic timetracker files and time the main entry points of
+timetracker.py on them:
+
+  load, save, resolve_name, stop_timer, report, report_cal,
+  report_break_in_service, report_cached, export_timers
+
+Each entry point runs in its own process on a fresh copy of the file, so
+caches of one don't help another.  The peak memory is read from /proc, where
+it doesn't carry over from the parent, and is left out without it.
+report_cached is report with the rollup cache already built.  resolve_name and
+stop_timer time TimeTracker.resolve() and stop(), they keep their old names so
+results can be compared with older runs.  export_timers is --export csv --by
+timer of the timers with one tag.  Results are printed as one JSON object per
+line, e.g. to compare runs with an older version:
+
+  ./benchmark.py --sizes 1000,100000 --output before.jsonl
+  ./benchmark.py --sizes 1000,100000 --output after.jsonl
+
+export_timers streams the data file, so its peak memory shouldn't depend on
+the size.  --check-memory fails when it grows from the smallest size to the
+largest by more than a megabyte of noise plus a few bytes per timer.
+"""
+
+import sys
+import os
+import json
+import random
+import datetime
+import optparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+entries = ["load", "save", "resolve_name", "stop_timer", "report",
+		   "report_cal", "report_break_in_service", "report_cached", "export_timers"]
+
+# Loading takes well over 100 bytes per timer
+stream_bytes_per_timer = 16
+
+# The peak memory of a process varies by this much anyway, e.g. by where the
+# allocator happens to grow the heap
+stream_noise_kb = 1024
+
+class HelpFormatter(optparse.IndentedHelpFormatter):
+	def format_description(self, description):
+		# optparse would fill help_text into one paragraph
+		return description.lstrip("\n")
+
+parser = optparse.OptionParser(usage="usage: %prog [options]", description=help_text,
+							   formatter=HelpFormatter())
+parser.add_option("--sizes",
+				  dest="sizes", default="1000,10000,100000", metavar="N,...",
+				  help="numbers of timers to generate, e.g. 1000,1000000")
+parser.add_option("--entries",
+				  dest="entries", default=",".join(entries), metavar="NAME,...",
+				  help="entry points to time")
+parser.add_option("--names",
+				  dest="names", default=300, type="int", metavar="N",
+				  help="number of distinct timer names")
+parser.add_option("--tags",
+				  dest="tags", default=20, type="int", metavar="N",
+				  help="number of distinct tags")
+parser.add_option("--comments",
+				  dest="comments", default=0.2, type="float", metavar="F",
+				  help="fraction of timers with a comment")
+parser.add_option("--file-version",
+				  dest="file_version", default=3, type="int", metavar="N",
+				  help="data file version to generate, 0 to 3")
+parser.add_option("--no-active",
+				  action="store_false", dest="active", default=True,
+				  help="don't leave the last timer running")
+parser.add_option("--repeat",
+				  dest="repeat", default=1, type="int", metavar="N",
+				  help="run each entry point N times")
+parser.add_option("--keep",
+				  dest="keep", metavar="DIR",
+				  help="generate the files in DIR and keep them")
+parser.add_option("-o", "--output",
+				  dest="output", metavar="FILE",
+				  help="append the results to FILE instead of printing them")
+parser.add_option("--check-memory",
+				  action="store_true", dest="check_memory", default=False,
+				  help="fail when the peak memory of export_timers grows with the size")
+parser.add_option("--child",
+				  dest="child", nargs=2, metavar="ENTRY FILE",
+				  help=optparse.SUPPRESS_HELP)
+
+def date_field(date, file_version):
+	if date == None:
+		return "None"
+	if file_version > 2:
+		return str((date - datetime.datetime(1970, 1, 1)).days * 86400
+				   + (date - datetime.datetime(1970, 1, 1)).seconds)
+	return '{:%Y-%m-%d %H:%M:%S}'.format(date)
+
+def generate(fname, count, names, tags, comments, file_version, active, seed = 1):
+	"""Write count timers of working days, ending about now"""
+	rnd = random.Random(seed)
+	tag_names = ["@tag{}".format(i) for i in xrange(tags)]
+	name_list = []
+	for i in xrange(names):
+		words = rnd.sample(tag_names, min(len(tag_names), rnd.randint(0, 2)))
+		words.append("task {}".format(i))
+		name_list.append(" ".join(words))
+	# A few names are used much more than others
+	weights = [1.0 / (i + 1) for i in xrange(names)]
+	total = sum(weights)
+	cumulative = []
+	c = 0
+	for w in weights:
+		c += w / total
+		cumulative.append(c)
+	def pick():
+		r = rnd.random()
+		lo = 0
+		hi = len(cumulative) - 1
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if cumulative[mid] < r:
+				lo = mid + 1
+			else:
+				hi = mid
+		return name_list[lo]
+	# About 12 timers a working day
+	days = count / 12 * 7 / 5 + 1
+	start = datetime.datetime.now().replace(hour = 8, minute = 0, second = 0, microsecond = 0)
+	start -= datetime.timedelta(days = days)
+	with open(fname, "wb") as f:
+		if file_version > 0:
+			f.write('VERSION\t{}\n'.format(file_version))
+		t = start
+		for i in xrange(count):
+			while t.hour >= 18 or t.weekday() > 4:
+				t = t.replace(hour = 8, minute = 0) + datetime.timedelta(days = 1)
+			end = t + datetime.timedelta(minutes = rnd.randint(5, 90), seconds = rnd.randint(0, 59))
+			name = pick()
+			comment = ""
+			if rnd.random() < comments:
+				comment = rnd.choice(["review", "call", "@tag0 follow up", "notes"])
+			if active and i == count - 1:
+				end = None
+			s = date_field(t, file_version)
+			e = date_field(end, file_version)
+			if file_version > 1:
+				f.write('TIMER\t{}\t{}\t{}\t{}\n'.format(s, e, name, comment))
+			elif file_version == 1:
+				f.write('TIMER\t{}\t{}\t{}\n'.format(s, e, name))
+			else:
+				f.write('TIMER\t{}\t{}\t{}\n'.format(name, s, e))
+			if end:
+				t = end + datetime.timedelta(minutes = rnd.choice([0, 0, 0, 5, 15]))
+	return name_list
+
+def import_timetracker():
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import timetracker
+	return timetracker
+
+def run_child(entry, fname):
+	"""Time entry on fname in this process and print the result as JSON"""
+	tt = import_timetracker()
+	tracker = tt.TimeTracker(fname)
+	devnull = open(os.devnull, "w")
+	count = 1
+	# Set up outside of the timed part
+	if entry in ("save", "resolve_name", "stop_timer"):
+		tracker.load()
+	if entry == "resolve_name":
+		tracker.load_name_index()
+		patterns = [tracker.timers[-i].name[:8] for i in xrange(1, min(len(tracker.timers), 50) + 1)]
+		patterns += ["task 1.*", "^@tag1", "no such timer"]
+		count = len(patterns)
+	if entry == "stop_timer":
+		now = tracker.timers[-1].start + datetime.timedelta(minutes = 10)
+	if entry == "report_cached":
+		stdout = sys.stdout
+		sys.stdout = devnull
+		tt.report(tracker.report_runs())
+		sys.stdout = stdout
+		# A new tracker, so the report reads the cache instead of using the
+		# timers loaded above
+		tracker = tt.TimeTracker(fname)
+	tt.reset_memory_peak()
+	memory_before = tt.memory_kb()
+	cpu_before = os.times()
+	wall_before = time.time()
+	stdout = sys.stdout
+	sys.stdout = devnull
+	try:
+		if entry == "load":
+			tracker.load()
+		elif entry == "save":
+			tracker.save()
+		elif entry == "resolve_name":
+			for p in patterns:
+				tracker.resolve(p)
+		elif entry == "stop_timer":
+			tracker.stop(now)
+		elif entry in ("report", "report_cached"):
+			tt.report(tracker.report_runs())
+		elif entry == "report_cal":
+			tt.report_cal(tracker.report_runs())
+		elif entry == "report_break_in_service":
+			tt.report_break_in_service(tracker.report_runs())
+		elif entry == "export_timers":
+			timers = tracker.stream(filter = tt.TimerFilter(["@tag1"], []))
+			count = tt.export(tt.timer_records(timers), tt.timer_fields, "csv", devnull)
+	finally:
+		sys.stdout = stdout
+	wall = time.time() - wall_before
+	cpu_after = os.times()
+	cpu = (cpu_after[0] - cpu_before[0]) + (cpu_after[1] - cpu_before[1])
+	memory = tt.memory_kb()
+	rss_before = None
+	rss = None
+	if memory_before and memory:
+		rss_before = memory_before[1]
+		rss = memory[0]
+	print json.dumps({"seconds": wall, "cpu_seconds": cpu, "operations": count,
+					  "timers": len(tracker.timers), "rss_before_kb": rss_before,
+					  "peak_rss_kb": rss})
+
+def main():
+	(options, args) = parser.parse_args()
+	if options.child:
+		run_child(options.child[0], options.child[1])
+		return
+	sizes = [int(s) for s in options.sizes.split(",")]
+	selected = options.entries.split(",")
+	for e in selected:
+		if e not in entries:
+			parser.error("unknown entry point " + e)
+	if options.keep:
+		workdir = options.keep
+		if not os.path.exists(workdir):
+			os.makedirs(workdir)
+	else:
+		workdir = tempfile.mkdtemp(prefix="ttbench")
+	out = sys.stdout
+	if options.output:
+		out = open(options.output, "a")
+	# (size, growth of the peak memory) of each export_timers run
+	export_growth = []
+	try:
+		for size in sizes:
+			source = os.path.join(workdir, "timetracker-{}-v{}".format(size, options.file_version))
+			generate(source, size, options.names, options.tags, options.comments,
+					 options.file_version, options.active)
+			for entry in selected:
+				for i in xrange(options.repeat):
+					# A fresh copy without any journal, index or cache files
+					rundir = tempfile.mkdtemp(prefix="ttrun", dir=workdir)
+					fname = os.path.join(rundir, "timetracker")
+					shutil.copyfile(source, fname)
+					child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+											  "--child", entry, fname],
+											 stdout=subprocess.PIPE)
+					output = child.communicate()[0]
+					shutil.rmtree(rundir)
+					if child.returncode != 0:
+						print >>sys.stderr, "failed:", entry, size
+						continue
+					result = json.loads(output.splitlines()[-1])
+					if entry == "export_timers" and result["peak_rss_kb"] != None:
+						export_growth.append((size, result["peak_rss_kb"] - result["rss_before_kb"]))
+					result.update({"entry": entry, "size": size, "names": options.names,
+								   "tags": options.tags, "file_version": options.file_version,
+								   "active": options.active,
+								   "timers_per_second": size / max(result["seconds"], 1e-9)})
+					out.write(json.dumps(result, sort_keys=True) + "\n")
+					out.flush()
+	finally:
+		if not options.keep:
+			shutil.rmtree(workdir)
+		if options.output:
+			out.close()
+	if options.check_memory:
+		if "export_timers" not in selected or len(set(sizes)) < 2:
+			parser.error("--check-memory needs export_timers and two sizes")
+		if len(export_growth) < 2:
+			print >>sys.stderr, "export_timers failed or its memory can't be read here, can't check it"
+			sys.exit(1)
+		small = min(export_growth)
+		large = max(export_growth)
+		# A small difference between the sizes is mostly noise, so that is
+		# allowed on top of the growth per timer
+		growth = large[1] - small[1]
+		allowed = stream_noise_kb + stream_bytes_per_timer * (large[0] - small[0]) / 1024.0
+		if growth > allowed:
+			print >>sys.stderr, "export_timers peak memory grows by {} KB from {} to {} timers, more than {:.0f} KB".format(
+				growth, small[0], large[0], allowed)
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
+
+# vim: tabstop=4:shiftwidth=4:noexpandtab
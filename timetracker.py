@@ -2,6 +2,10 @@
 #
 #  TimeTracker
 #
+import time
+# For --profile
+started_at = (time.time(), time.clock())
+
 help_text = """
 Setup:
   Copy timetracker.py somewhere.
@@ -13,10 +17,25 @@ Typical usage:
   tt  name...       # start a timer
   tt  -l|--leap M name...  # start a timer M minutes ago
   tt  -a|--at HH:MM name...  # start a timer at HH:MM (24-hour clock)
+  tt  -a|--at "YYYY-MM-DD HH:MM" name...  # start a timer on another day
+  tt  --insert "YYYY-MM-DD HH:MM" --to HH:MM name...  # add a forgotten timer
   tt  -s|--stop     # stop active timer
   tt                # prints active timer
   tt  -r|--report   # prints a report
   tt  -c|--calendar # a report like a calendar
+  tt  -r --since YYYY-MM-DD --until YYYY-MM-DD  # report on some days
+  tt  -c --last-weeks N  # report on this and the previous N-1 weeks
+  tt  --compact     # fold the journal into the data file
+  tt  --archive YYYY-MM-DD  # archive timers that started before that day
+  tt  --check [--repair]    # find (and fix) overlapping or unordered timers
+  tt  --convert FILE        # copy all timers to FILE, e.g. a SQLite database
+  tt  -r -f FILE -f FILE... # report on the timers of several files
+  tt  --profile ... # print where the time of a command goes
+  tt  --daemon      # keep the timers in memory for faster commands
+  tt  --complete PREFIX  # list names and tags for shell completion
+  tt  --export jsonl|csv [--by day|week|month]  # timers or totals as data
+  tt  -r --tag @a,@b --tag=-@c  # report on timers with @a or @b, but not @c
+  tt  -r --name RE  # report on timers with a name that matches RE
 
   "name..." above is a list of words, do not put quotes around them.  Any
   number of words can be prefixed by the tag character, "@".
@@ -36,7 +55,8 @@ Gui usage
   Start/Run - start the currently selected row by running tt with the text box
               as arguments (not searching names) or edit the text box to run
 			  aribtrary arguments
-  Reload - reload the timer in case they were modified somewhere else
+  Reload - reload the timers, e.g. after editing the data file.  Timers
+           started or stopped by tt show up without it.
   Stdout - open a window displaying stdout (useful to see reports)
   Help - open a window with this message
 
@@ -55,6 +75,92 @@ Use a different character than @ to mark tags.  (@ works in most shells.)
 Use a different font in the Gui:
 	FONT	Courier New	14
 
+Old timers can be moved out of the way with --archive.  They are saved per
+month in ~/.timetracker.YYYY-MM, listed in ~/.timetracker.archive, and are only
+read by reports with --with-archive or --since before the first timer that was
+not archived.  Their names stay in the name index, so they are still found and
+completed.
+
+A data file with a name that ends in .sqlite, .sqlite3 or .db is a SQLite
+database instead, e.g. tt -f ~/timetracker.sqlite.  It has indexes on the
+start, name and tags of the timers, so commands only read the timers they
+need and reports are added up by SQLite, without a journal, name index, rollup
+cache or archive.  Its settings are rows of the settings table, e.g.
+('TAGCHAR', '@').  tt --convert FILE copies all timers, archived ones too, and
+the settings to the new data file FILE, e.g. from ~/.timetracker to a SQLite
+database or back.
+
+Reports keep the totals of days that can't change anymore in
+~/.timetracker.rollup, so they only read the timers of the last few days.
+When the data file was edited by hand, the cache is built again by the next
+report.  tt --check also compares it with the timers.
+
+When tt is slow, --profile prints the wall time, CPU time, how far the RSS
+(resident memory) peaked above where it was at the start of the phase and the
+number of records of each phase of the command to stderr.  The memory is read
+from /proc, without it the column is left empty.  --profile-output FILE
+appends the same as a line of JSON to FILE instead.  Setting TT_PROFILE=1 in
+the environment is the same as --profile, any other value is used as the file
+for --profile-output.  --cprofile FILE, or TT_CPROFILE=FILE, runs the command
+under cProfile and dumps the stats to FILE.
+
+tt --check looks for timers that are out of order, overlap, have no time or
+end before they start, and for more than one active timer, e.g. after editing
+the file by hand.  Reports and loading only parts of the file expect the
+timers to be in order without overlaps.  tt --repair, or --check --repair,
+sorts the timers by start, ends each one where the next one starts, removes
+the ones that are left without time and saves the file.  A timer that encloses
+others continues after them.  The time that two timers both had is printed,
+it stays with the later one.  The old file is kept as the back up.
+
+tt --complete PREFIX prints the names and tags that start with PREFIX, one
+per line, the most used first.  The zsh completion in _timetracker uses it.
+
+tt --export jsonl or tt --export csv writes the timers, one per line, as JSON
+or CSV for other programs.  With --by day, week or month it writes the totals
+of each name and tag of those, the same totals as tt -r.  --since, --until,
+--last-weeks and --with-archive select the timers the same as for reports.
+Timers have the fields start, end, seconds, name, comment and tags, totals
+have period, date, type (name or tag), key and seconds.  Weeks are split at
+the end of a month like in reports.
+
+Reports and exports can be limited to some timers with --tag and --name.  A
+timer needs one of the comma separated tags of each --tag, and a tag written
+as -TAG means not having TAG.  Its name has to match the regular expression
+of each --name.  These reports add up the timers themselves instead of using
+the cache in ~/.timetracker.rollup, but only look at the timers that match.
+
+tt --insert START --to END name... adds a timer from START to END between the
+others, e.g. for a meeting last week that you forgot to time.  START and END
+are "YYYY-MM-DD HH:MM" or YYYY-MM-DDTHH:MM, or HH:MM for today or the day of
+START.  Only the timers it overlaps are changed: a timer that was running at
+START is cut off there and continues at END, timers that started before END
+now start at END, and timers that also ended before END are removed.  The
+changes are appended to the journal like any others.  --at takes the same
+dates.
+
+Reports and --export can add up several data files, e.g. one per person in a
+team: repeat -f, or give a glob like -f '~/team/*.tt'.  -f LABEL=FILE adds
+the tag @LABEL to the timers of FILE, and --label-files labels each file with
+its name without the extension, so the reports also have the totals of each
+file.  The files are read one timer at a time and merged by start, so only a
+few timers of each file are in memory.  --jobs N adds up the files in N
+processes instead and merges the days.
+
+tt --daemon keeps the timers in memory and listens on ~/.timetracker.sock.
+While it runs, tt sends showing, starting and stopping timers and the reports
+to it instead of loading the file itself, unless --no-daemon is given.  The
+daemon loads the file again when something else changed it.  When it doesn't
+answer within daemon_timeout seconds, tt runs the command itself, except a
+command that changes timers and was sent already, which the daemon may still
+run.
+
+Starting and stopping timers does not rewrite the data file.  Those changes
+are appended to a journal next to it (~/.timetracker.journal), which is folded
+back into the data file every so often or when running tt --compact.  Run
+tt --compact before editing the data file by hand.  A journal that is left
+belongs to the file as it was, it is ignored after the edit.
+
 Examples:
   tt @tc-123 bug 456 bad cse
   tt @tc-222 bug 333 optnone
@@ -87,16 +193,121 @@ There is only one data structures.
 1. array of timers
   - record start time, end time, and name
    - tuple of (string, datetime, datetime)
-2. TODO: an array to archive older timers so they aren't include in reports
-  or searches
+2. archived timers, in segment files per month that are only read when
+   needed.  The archive file lists them, and the names in them with their
+   uses and the number of the last archived timer with each, as
+     SEGMENT  YYYY-MM  count  first-start  last-start
+     NAME     name  uses  last
+3. the positions of the timers with each tag and each name, built in the
+   daemon and the GUI when a report is limited with --tag or --name and
+   updated with the timers.  A single tt command matches the timers instead,
+   the index is not saved.
+
+Since version 3 the data file stores the start and end of a timer as seconds
+since 1970-01-01 00:00 of the local clock.  Files of older versions are still
+read, and are upgraded by the first command that changes timers.
+
+The data file is only rewritten by save().  Everything else appends small
+records to the journal:
+  START   start name comment  - append a new timer
+  STOP    index end           - stop a timer
+  ADJUST  index start end     - move a timer, e.g. for --leap or --at
+  INSERT  index start end name comment  - insert a timer before index
+  DELETE  index               - remove a timer that --insert covered
+The index counts from the end of the timers as they were when the record was
+written, so -1 is the last timer.  That way the journal also applies to the
+last few timers read by load_tail(), which is all that showing, starting and
+stopping a timer needs.
+
+Names are resolved with an index of the distinct names in
+~/.timetracker.names, most recently used last, the archived timers included.
+It starts with "NAMES gen archived" and is rebuilt when gen does not match the
+data file or archived the number of archived timers, otherwise started timers
+append their name to it.  The archive manifest lists the archived names, so
+rebuilding the index doesn't read the segments.  Plain strings are looked up
+by their trigrams, regular expressions are tried on the distinct names.
+save() writes each name once as "NAME name uses last", where uses is the
+number of timers with that name and last the number of the last one, and
+every appended "NAME name" is one more use by the next timer.  A timer
+inserted in the past appends "NAME name 1 last" with the number it has there.
+--complete ranks names by their uses, halved for every complete_half_life
+timers started since the name was last used, and a tag by the sum of the
+names it is in.  It only reads the top of the data file for gen.
+
+Reports work on runs of timers that started on the same day, with the totals
+per name and tag of each run.  ~/.timetracker.rollup caches the runs of days
+that are over:
+  ROLLUP tag size mtime  - the tag character and the data file it is for
+  RUN  day         - a run, followed by its totals
+  N    seconds name
+  T    seconds tag
+  UPTO time        - the runs before this have all timers before time
+  INVALIDATE time  - drop the runs from time on, a timer there was changed
+Runs after the last UPTO are ignored, they were cut short.  Only the timers
+after UPTO are loaded for a report and then added to the cache.  Runs are
+only appended after the last one, an INVALIDATE makes the next report write
+the cache again, so the RUN lines are in order and a report of some days
+bisects the file for the first one.  When the cache ends before that day, the
+report only loads the timers from there on and doesn't cache them.  When numpy
+is installed, the runs of many timers are added up by day_runs_numpy() with
+the timers as columns of seconds, name codes and tag set codes.  With --jobs N
+parallel_day_runs() splits many timers where a month starts, and a pool of N
+processes adds up the parts.  The processes are forked with the timers in
+memory, so only the runs are sent back, and archived segments are loaded and
+added up by a process each.  Days and weeks never cross a month in reports,
+so the runs are just put back together in order and print the same.
+The cache is only used while the size and modification time of the data file
+are the ones in its ROLLUP line.  The line has a fixed width, and save()
+writes the new ones over it when they were still right before saving.
+
+The first line of the journal is "JOURNAL gen version size" and the journal
+is only replayed when gen matches the JOURNAL line of the data file and size
+is the size of the data file.  save() bumps gen, so a journal that was
+already folded into the data file is ignored even if removing it failed.
+Only save() writes the data file while there is a journal, so a different
+size means the file was edited, and the records, which count timers from the
+end, could change the wrong timers.  A last record without a newline was cut
+short and is dropped before the next one is appended.
+
+A TimeTracker object has the timers of a data file and everything that goes
+with them, and importing timetracker.py doesn't do anything else.  Other
+Python programs can use it instead of running tt for every change:
+  import timetracker
+  tracker = timetracker.open_tracker("~/.timetracker")
+  with tracker.locked():
+      tracker.load()
+      tracker.stop()
+      tracker.start(tracker.resolve("bug 8"), "a comment")
+      tracker.commit()
+  runs = tracker.report_runs(since, until)
+  timetracker.report(runs)
+stop(), adjust() and insert() change timers, start() stops the active one and
+adds one, and commit() writes the changes to the journal or data file.  They
+load the last timers themselves when nothing was loaded yet.  open_tracker()
+returns the TimeTracker for a data file, a SqliteTracker for a SQLite
+database.  That writes the same journal records as inserts, updates and
+deletes of single rows, in a transaction that commit() commits, and keeps the
+row ids of the timers in memory next to them.  main() runs a command line on a
+TimeTracker, for the command line, the daemon and the GUI.
 
 Basic operation:
-1. read file of timers
+1. read file of timers and replay the journal
 2. parse and handle arguments
   - print the active timer when no options or arguments
   - start new timer when just name arguments
   - handle special options
-3. save file
+3. append changes to the journal, or save the file when the journal gets
+   long or the file has an old version
+
+Commands that change timers hold an exclusive flock() on ~/.timetracker.lock
+from loading until the changes are written, the others share it.  The GUI and
+the daemon take it around each command.  The data file, name index, rollup
+and archive manifest are written to a temporary file that is renamed over the
+old one, so they are never half written.  When the data file or journal
+changed anyway since they were loaded, e.g. by an editor, a command loads them
+again and applies its own journal records to that before writing.  Reports
+append to the rollup cache under a lock on the cache itself and skip caching
+when another report has it.
 """
 
 import sys
@@ -106,12 +317,34 @@ import calendar
 import datetime
 import optparse
 import shutil
+import itertools
+import tempfile
+import contextlib
+import gc
+import errno
+import bisect
+import array
+import heapq
+import glob
+import collections
+try:
+	import fcntl
+except ImportError:
+	# Windows, where tt doesn't lock its files
+	fcntl = None
+imported_at = (time.time(), time.clock())
 
 
 parser = optparse.OptionParser(usage="usage: %prog [options] name...")
 parser.add_option("-f", "--file",
-				  dest="filename", default="~/.timetracker", metavar="FILE",
-				  help="use FILE for time tracker data")
+				  action="append", dest="files", metavar="FILE",
+				  help="use FILE for time tracker data, default ~/.timetracker.  Reports can use several, repeat -f or give a glob, LABEL=FILE tags the timers of FILE with LABEL")
+parser.add_option("--label-files",
+				  action="store_true", dest="label_files", default=False,
+				  help="tag the timers of each file of a report with the name of the file")
+parser.add_option("--jobs",
+				  dest="jobs", default=1, type="int", metavar="N",
+				  help="add up a report in N processes, by file, month or archived segment")
 parser.add_option("-v", "--verbose",
 				  action="store_true", dest="verbose", default=False,
 				  help="don't print status messages to stdout")
@@ -135,52 +368,158 @@ parser.add_option("-l", "--leap",
 				  help="Do a quantum leap to N minutes ago and run the command from that time")
 parser.add_option("-a", "--at",
 				  dest="at_time", metavar="N", type="str",
-				  help="Start timer as if it was today at HH:MM (24-hour clock)")
+				  help="Start timer as if it was today at HH:MM (24-hour clock), or at \"YYYY-MM-DD HH:MM\"")
+parser.add_option("--insert",
+				  dest="insert", metavar="START", type="str",
+				  help="insert a timer from START, \"YYYY-MM-DD HH:MM\" or HH:MM today, up to --to")
+parser.add_option("--to",
+				  dest="insert_to", metavar="END", type="str",
+				  help="end the timer of --insert at END, \"YYYY-MM-DD HH:MM\" or HH:MM on the day of START")
 
 parser.add_option("-b", "--report-break-in-service",
 				  action="store_true", dest="report_break_in_service", default=False,
 				  help="generate a break in service report")
 
+parser.add_option("--compact",
+				  action="store_true", dest="compact", default=False,
+				  help="fold the journal into the data file")
+
+parser.add_option("--archive",
+				  dest="archive", metavar="YYYY-MM-DD", type="str",
+				  help="archive timers that started before YYYY-MM-DD")
+parser.add_option("--convert",
+				  dest="convert", metavar="FILE", type="str",
+				  help="copy all timers, also archived ones, to the new data file FILE, a SQLite database when it ends in .sqlite or .db")
+parser.add_option("--check",
+				  action="store_true", dest="check", default=False,
+				  help="check the timers for overlaps and timers out of order")
+parser.add_option("--repair",
+				  action="store_true", dest="repair", default=False,
+				  help="check, fix what was found and save the file")
+parser.add_option("--with-archive",
+				  action="store_true", dest="with_archive", default=False,
+				  help="include archived timers in reports")
+
+parser.add_option("--since",
+				  dest="since", metavar="YYYY-MM-DD", type="str",
+				  help="only report timers that started on or after YYYY-MM-DD")
+parser.add_option("--until",
+				  dest="until", metavar="YYYY-MM-DD", type="str",
+				  help="only report timers that started on or before YYYY-MM-DD")
+parser.add_option("--last-weeks",
+				  dest="last_weeks", metavar="N", type="int",
+				  help="only report timers of this week and the N-1 weeks before")
+
+parser.add_option("--tag",
+				  dest="tags", metavar="TAGS", action="append",
+				  help="only report timers with one of the comma separated TAGS, -TAG for timers without TAG")
+parser.add_option("--name",
+				  dest="names", metavar="RE", action="append",
+				  help="only report timers with a name that matches RE")
+
+parser.add_option("--export",
+				  dest="export", metavar="FORMAT", type="choice", choices=["jsonl", "csv"],
+				  help="write the timers or totals as jsonl or csv")
+parser.add_option("--by",
+				  dest="export_by", metavar="PERIOD", type="choice", default="timer",
+				  choices=["timer", "day", "week", "month"],
+				  help="export the totals per day, week or month instead of the timers")
+
 parser.add_option("-g", "--gui",
 				  action="store_true", dest="gui", default=False,
 				  help="Run a simple Qt gui (ignores other arguments)")
 
-(options, optargs) = parser.parse_args()
+parser.add_option("--complete",
+				  dest="complete", metavar="PREFIX", type="str",
+				  help="print the names and tags that start with PREFIX")
+
+parser.add_option("--daemon",
+				  action="store_true", dest="daemon", default=False,
+				  help="keep the timers in memory and serve other tt commands")
+parser.add_option("--no-daemon",
+				  action="store_false", dest="use_daemon", default=True,
+				  help="don't send the command to a running daemon")
+
+parser.add_option("--profile",
+				  action="store_true", dest="profile", default=False,
+				  help="print the time spent in each phase to stderr")
+parser.add_option("--profile-output",
+				  dest="profile_output", metavar="FILE",
+				  help="append the time spent in each phase to FILE as JSON")
+parser.add_option("--cprofile",
+				  dest="cprofile", metavar="FILE",
+				  help="run under cProfile and dump the stats to FILE")
+
+version = 3
 
-# TODO: Hmm, it's convenient to use globals, but should I not use them? I was
-# trying to avoid creating a class, but that might be the best solution. 
-# One nasty requirement of globals is having to declare them as global in
-# functions, which leads to non-obvious errors when you don't.
+# Changes are appended to the journal until it has more than journal_limit
+# records, then it is folded into the data file.
+journal_limit = 256
 
-version = 2
-timers = []
-save_changes = False
+# Showing, starting and stopping a timer only loads the last tail_length
+# timers.
+tail_length = 64
+
+# Run the command without the daemon when it doesn't answer within this many
+# seconds
+daemon_timeout = 10
+
+# --complete halves the uses of a name for every this many timers since it was
+# last used
+complete_half_life = 1000
+
+# Add up the durations with numpy, if it is installed, for this many timers
+# or more.
+numpy_threshold = 5000
+
+# With --jobs, add up the days of this many timers or more in a process pool
+parallel_threshold = 20000
 
 # These can be changed by settings in a file
 default_tag_char = "@"
 default_font_name = "Courier New"
 default_font_size = 14
-tag_char = default_tag_char
-font_name = default_font_name
-font_size = default_font_size
-
-# Save it, because at least 1 option will change it.
-now = datetime.datetime.now().replace(microsecond=0)
-
-class Timer:
 
-	def __init__(self, name, comment, start, end = None):
-		self.name = name.strip()
-		self.comment = comment.strip()
-		self.start = start
-		self.end = end
+# Most timers share a few hundred names, so timers with the same name and
+# comment share the same strings and tag set.
+shared_names = {}
+shared_strings = {}
+tag_patterns = {}
+
+def tag_pattern(char):
+	pat = tag_patterns.get(char)
+	if pat == None:
+		pat = re.compile("".join(["(", char, "\w+)"]))
+		tag_patterns[char] = pat
+	return pat
+
+def shared_name(name, comment, tag_char):
+	"""Return the shared (name, comment, tags) for a timer"""
+	key = (name, comment, tag_char)
+	shared = shared_names.get(key)
+	if shared == None:
+		# intern() only takes str, the gui passes unicode.
+		name = name.strip()
+		name = shared_strings.setdefault(name, name)
+		comment = comment.strip()
+		comment = shared_strings.setdefault(comment, comment)
 		# Find words that start with tag_char.  include tag_char so it is
 		# obvious when used for things like reporting
-		s = " ".join([self.name, self.comment])
-		pat = re.compile("".join(["(", tag_char, "\w+)"]))
-		self.tags = frozenset(pat.findall(s))
-		if not self.tags:
-			self.tags = frozenset(["No tags"])
+		s = " ".join([name, comment])
+		tags = frozenset(tag_pattern(tag_char).findall(s))
+		if not tags:
+			tags = frozenset(["No tags"])
+		shared = (name, comment, tags)
+		shared_names[key] = shared
+	return shared
+
+class Timer(object):
+	__slots__ = ('name', 'comment', 'start', 'end', 'tags')
+
+	def __init__(self, name, comment, start, end = None, tag_char = default_tag_char):
+		self.name, self.comment, self.tags = shared_name(name, comment, tag_char)
+		self.start = start
+		self.end = end
 
 	def active(self):
 		return self.end == None
@@ -198,41 +537,587 @@ class Timer:
 		return "{:%Y-%m-%d %H:%M}-now | {}".format(self.start, self.name)
 
 
-def main():
-	global now
-	fname = os.path.expanduser(options.filename)
+def memory_kb():
+	"""The peak resident memory since reset_memory_peak() and the current
+	resident memory of the process in KB, None where /proc doesn't have
+	them.  ru_maxrss can't stand in, it keeps the peak of the parent across
+	fork and exec."""
+	try:
+		with open("/proc/self/status") as f:
+			status = dict(line.split(":", 1) for line in f if ":" in line)
+		return (int(status["VmHWM"].split()[0]), int(status["VmRSS"].split()[0]))
+	except (IOError, KeyError, ValueError):
+		return None
+
+def reset_memory_peak():
+	"""Start the peak of memory_kb() again from the current resident memory"""
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+	except IOError:
+		# Before Linux 4.0 the peak stays the one since exec
+		pass
+
+class Profile(object):
+	"""Wall time, CPU time, how far the resident memory peaked above where it
+	was at the start in KB and number of records of the phases of a command.
+	Phases nest, the time of an inner phase is not counted for the outer."""
+
+	def __init__(self):
+		self.enabled = False
+		self.time = None
+		self.order = []
+		self.totals = {}
+		self.stack = []
+		self.mark = None
+
+	def sample(self):
+		# Counting objects would take longer than most phases
+		return (time.time(), time.clock(), memory_kb())
+
+	def add(self, phase, wall, cpu, peak = None, records = None):
+		if phase not in self.totals:
+			self.order.append(phase)
+			self.totals[phase] = [0.0, 0.0, None, None]
+		total = self.totals[phase]
+		total[0] += wall
+		total[1] += cpu
+		if peak != None:
+			total[2] = (total[2] or 0) + peak
+		if records != None:
+			total[3] = (total[3] or 0) + records
+
+	def start(self, parsed_at):
+		self.enabled = True
+		self.time = datetime.datetime.now().replace(microsecond=0)
+		self.add("import", imported_at[0] - started_at[0], imported_at[1] - started_at[1])
+		self.add("options", parsed_at[0] - imported_at[0], parsed_at[1] - imported_at[1])
+		self.stack = ["main"]
+		reset_memory_peak()
+		self.mark = self.sample()
+
+	def switch(self):
+		now = self.sample()
+		mark = self.mark
+		peak = None
+		if now[2] != None and mark[2] != None:
+			peak = max(now[2][0] - mark[2][1], 0)
+		self.add(self.stack[-1], now[0] - mark[0], now[1] - mark[1], peak)
+		reset_memory_peak()
+		# Don't count the time of sample() itself
+		self.mark = self.sample()
+
+	def enter(self, phase):
+		if self.enabled:
+			self.switch()
+			self.stack.append(phase)
+
+	def leave(self, records = None):
+		if self.enabled:
+			self.switch()
+			phase = self.stack.pop()
+			if records != None:
+				self.add(phase, 0, 0, None, records)
+
+	def finish(self, output):
+		if not self.enabled:
+			return
+		self.switch()
+		if output:
+			import json
+			phases = []
+			for phase in self.order:
+				wall, cpu, peak, records = self.totals[phase]
+				phases.append({"phase": phase, "wall": wall, "cpu": cpu,
+							   "peak_rss_growth_kb": peak, "records": records})
+			with open(output, "ab") as f:
+				f.write(json.dumps({"time": date_to_str(self.time), "argv": sys.argv[1:],
+									"phases": phases}) + "\n")
+			return
+		total = [0.0, 0.0]
+		sys.stderr.write("phase       wall ms    cpu ms  RSS peak+KB   records\n")
+		for phase in self.order:
+			wall, cpu, peak, records = self.totals[phase]
+			total[0] += wall
+			total[1] += cpu
+			line = "{:<10} {:>8.1f} {:>9.1f}".format(phase, wall * 1000, cpu * 1000)
+			if peak != None:
+				line += " {:>11d}".format(peak)
+			elif records != None:
+				line += " " * 12
+			if records != None:
+				line += " {:>9d}".format(records)
+			sys.stderr.write(line + "\n")
+		sys.stderr.write("{:<10} {:>8.1f} {:>9.1f}\n".format("total", total[0] * 1000, total[1] * 1000))
+
+profile = Profile()
+
+def profiled(phase, records = None):
+	"""Decorator to count the time of a function as phase, and records() of
+	its result and arguments as its number of records."""
+	def wrap(f):
+		def profiled_function(*args, **kwargs):
+			profile.enter(phase)
+			done = False
+			try:
+				result = f(*args, **kwargs)
+				done = True
+				return result
+			finally:
+				# records() of a function that raised would hide its error
+				if records and done:
+					profile.leave(records(result, *args))
+				else:
+					profile.leave()
+		profiled_function.__name__ = f.__name__
+		profiled_function.__doc__ = f.__doc__
+		return profiled_function
+	return wrap
+
+def run(argv = None):
+	"""Run main() for the command line, profiled when asked for"""
+	if argv == None:
+		argv = sys.argv[1:]
+	(options, optargs) = parser.parse_args(argv)
+	parsed_at = (time.time(), time.clock())
+	output = options.profile_output
+	env = os.environ.get("TT_PROFILE")
+	if env and env != "1" and not output:
+		output = env
+	files = data_files(options.files, options.label_files)
+	options.filename = files[0][1]
+	group = len(files) > 1 or files[0][0] != None
+	if not group:
+		tracker = open_tracker(options.filename, options.verbose)
+		tracker.jobs = options.jobs
+	elif group_command(options, optargs):
+		tracker = TrackerGroup([(label, open_tracker(fname, options.verbose)) for label, fname in files], options.jobs)
+	else:
+		parser.error("only reports and --export can use several data files or labels")
+	if options.daemon:
+		daemon(tracker)
+		return
+	cprofile = options.cprofile or os.environ.get("TT_CPROFILE")
+	if options.profile or output or env:
+		profile.start(parsed_at)
+	elif (not cprofile and not group and options.use_daemon and daemon_command(options)
+			and call_daemon(tracker.fname, argv, writes(options, optargs))):
+		return
+	# The GUI locks around each command
+	locks = []
+	if not options.gui:
+		exclusive = writes(options, optargs)
+		locks = [lock_file(fname, exclusive, options.verbose) for label, fname in files]
+		tracker.shared_lock = not exclusive
+	try:
+		if cprofile:
+			import cProfile
+			cProfile.runctx("main(tracker, options, optargs)", globals(), locals(), cprofile)
+		else:
+			main(tracker, options, optargs)
+	finally:
+		for lock in locks:
+			unlock_file(lock)
+	profile.finish(output)
+
+def lock_name(fname):
+	return fname + ".lock"
+
+def lock_file(fname, exclusive, verbose = False):
+	"""Lock fname against other tt commands until unlock_file().  Commands
+	that only read it share the lock."""
+	if fcntl == None:
+		return None
+	lock = open(lock_name(fname), "ab")
+	if exclusive:
+		mode = fcntl.LOCK_EX
+	else:
+		mode = fcntl.LOCK_SH
+	try:
+		fcntl.flock(lock, mode | fcntl.LOCK_NB)
+	except IOError:
+		if verbose:
+			print "Waiting for", lock.name
+		fcntl.flock(lock, mode)
+	return lock
+
+def unlock_file(lock):
+	if lock:
+		lock.close()
+
+def writes(options, optargs):
+	"""Return whether the command in options changes timers, and needs the
+	exclusive lock.  Only such commands save the data file, e.g. to upgrade
+	it."""
+	return bool(options.stop or optargs or options.compact or options.archive or options.insert or options.repair)
+
+@contextlib.contextmanager
+def collector_paused():
+	"""Don't run the garbage collector in the block.  Loading makes a lot of
+	objects without any cycles, the collector would only walk them again and
+	again."""
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		yield
+	finally:
+		if enabled:
+			gc.enable()
+
+@contextlib.contextmanager
+def replacing(fname):
+	"""Open a temporary file to write a new fname to, and rename it to fname
+	when done"""
+	f = tempfile.NamedTemporaryFile(dir = os.path.dirname(fname) or ".",
+			prefix = os.path.basename(fname) + ".", suffix = ".tmp", delete = False)
+	try:
+		yield f
+		f.flush()
+		os.fsync(f.fileno())
+	except:
+		f.close()
+		os.remove(f.name)
+		raise
+	f.close()
+	# The temporary file is only readable by us
 	if os.path.exists(fname):
-		load(fname)
+		shutil.copymode(fname, f.name)
+	else:
+		umask = os.umask(0)
+		os.umask(umask)
+		os.chmod(f.name, 0666 & ~umask)
+	os.rename(f.name, fname)
+
+def socket_name(fname):
+	return fname + ".sock"
+
+def group_command(options, optargs):
+	"""Return whether the command in options can run on several data files"""
+	return bool((options.report or options.report_cal or options.report_break_in_service or options.export)
+				and not (writes(options, optargs) or options.gui or options.daemon or options.check
+						 or options.convert or options.complete != None))
+
+def daemon_command(options):
+	"""Return whether the daemon can run the command in options"""
+	# Exports are written as they are made, the daemon would have to keep
+	# them in memory.  The file of --convert is relative to the directory of
+	# the command, not of the daemon.
+	return not (options.gui or options.compact or options.archive or options.complete != None
+				or options.export or options.convert)
+
+def call_daemon(fname, argv, writes = False):
+	"""Run the command line in a running daemon and print its output.
+	Return False when there is no daemon or it didn't answer in time.  A
+	command that writes isn't run twice, it fails when the daemon got it but
+	didn't answer."""
+	import socket
+	if not hasattr(socket, "AF_UNIX"):
+		return False
+	sname = socket_name(fname)
+	if not os.path.exists(sname):
+		return False
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(daemon_timeout)
+	try:
+		client.connect(sname)
+	except socket.error:
+		# The daemon is gone and left its socket, or is stuck (socket.timeout
+		# is a socket.error)
+		client.close()
+		return False
+	import json
+	try:
+		client.sendall(json.dumps({"argv": argv}) + "\n")
+		client.shutdown(socket.SHUT_WR)
+		reply = ""
+		while True:
+			data = client.recv(65536)
+			if not data:
+				break
+			reply += data
+		client.close()
+		reply = json.loads(reply)
+	except (socket.error, ValueError):
+		# It timed out, or died and left no or only part of an answer
+		client.close()
+		if writes:
+			print >>sys.stderr, "The daemon didn't answer and may still run the command, check with tt"
+			sys.exit(1)
+		print >>sys.stderr, "The daemon didn't answer, running the command without it"
+		return False
+	sys.stdout.write(reply["output"].encode("utf-8"))
+	if reply["status"]:
+		sys.exit(reply["status"])
+	return True
+
+def file_state(fname):
+	"""Return something that changes when fname or its journal change"""
+	state = []
+	for name in (fname, journal_name(fname)):
+		if os.path.exists(name):
+			st = os.stat(name)
+			state.append((st.st_size, st.st_mtime, st.st_ino))
+		else:
+			state.append(None)
+	return state
+
+def daemon(tracker):
+	import socket
+	import json
+	import StringIO
+	import traceback
+	fname = tracker.fname
+	sname = socket_name(fname)
+	if os.path.exists(sname):
+		client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			client.connect(sname)
+			client.close()
+			print "A daemon is already running for", fname
+			return
+		except socket.error:
+			os.remove(sname)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(sname)
+	server.listen(5)
+	print "Serving", fname, "on", sname
+	# Remove the socket when killed
+	import signal
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	tracker.resident = True
+	try:
+		while True:
+			conn, addr = server.accept()
+			try:
+				request = ""
+				while True:
+					data = conn.recv(65536)
+					if not data:
+						break
+					request += data
+				try:
+					argv = [a.encode("utf-8") for a in json.loads(request)["argv"]]
+				except (ValueError, KeyError, TypeError, AttributeError):
+					# Checking for a running daemon connects and sends nothing
+					continue
+				stdout = sys.stdout
+				stderr = sys.stderr
+				sys.stdout = StringIO.StringIO()
+				sys.stderr = sys.stdout
+				status = 0
+				try:
+					serve_command(tracker, argv)
+				except SystemExit, e:
+					status = e.code
+				except Exception:
+					traceback.print_exc()
+					status = 1
+				finally:
+					output = sys.stdout.getvalue()
+					sys.stdout = stdout
+					sys.stderr = stderr
+				if status:
+					# Don't trust what is in memory after an error
+					tracker.loaded_state = None
+				conn.sendall(json.dumps({"output": output.decode("utf-8", "replace"), "status": status}))
+			except socket.error:
+				# The client went away, serve the next one
+				pass
+			finally:
+				conn.close()
+	finally:
+		tracker.resident = False
+		server.close()
+		os.remove(sname)
+
+def serve_command(tracker, argv):
+	"""Run main() for a command line sent to the daemon"""
+	tracker.forget_changes()
+	(options, optargs) = parser.parse_args(argv)
+	options.filename = tracker.fname
+	if not daemon_command(options) or options.daemon:
+		print "The daemon can't run this command, use --no-daemon"
+		sys.exit(2)
+	tracker.verbose = options.verbose
+	tracker.jobs = options.jobs
+	with tracker.locked(writes(options, optargs)):
+		# Load again when another process changed the file
+		if tracker.loaded_state != file_state(tracker.fname):
+			if os.path.exists(tracker.fname):
+				tracker.load()
+			else:
+				tracker.clear()
+				tracker.loaded_state = file_state(tracker.fname)
+		main(tracker, options, optargs)
+
+def main(tracker, options, optargs):
+	"""Run the command line in options and optargs on tracker"""
+	if options.complete != None:
+		for n in tracker.complete(options.complete):
+			print n
+		return
+	if tracker.resident:
+		# The daemon has all timers in memory
+		pass
+	elif os.path.exists(tracker.fname):
+		# Showing, starting and stopping timers only needs the last few
+		# timers, reports only need the timers after the rollup cache.
+		# Everything else loads all of them.
+		if options.gui or options.compact or options.archive or options.check or options.repair or options.convert:
+			tracker.load()
+		elif ((options.report or options.report_cal or options.report_break_in_service or options.export)
+				and not writes(options, optargs)):
+			# report_runs() loads what is not in the rollup cache.  A
+			# command that also changes timers loads them like any other.
+			pass
+		elif not tracker.load_tail(tail_length):
+			tracker.load()
 	name = None
 	if options.gui:
-		gui()
+		gui(tracker)
 		return
+	now = datetime.datetime.now().replace(microsecond=0)
 	if optargs:
 		name, sep, comment = " ".join(optargs).partition(":")
-		name = resolve_name(name)
+		if not options.explicit:
+			name = tracker.resolve(name)
+		if options.verbose:
+			print "Using name:", name
 	if options.leap:
 		now = now - datetime.timedelta(seconds = options.leap*60)
 	if options.at_time:
-		clock = datetime.datetime.strptime(options.at_time, "%H:%M")
-		now = now.replace(hour = clock.hour, minute = clock.minute, second = 0, microsecond = 0)
-	if options.stop:
-		stop_timer()
+		now = parse_time(options.at_time, now)
+	if options.insert:
+		start = parse_time(options.insert, now)
+		if options.insert_to == None:
+			parser.error("--insert needs --to")
+		end = parse_time(options.insert_to, start)
+		if not name:
+			parser.error("--insert needs a name")
+		if end <= start:
+			parser.error("--to has to be after --insert")
+		try:
+			inserted, changes, removed = tracker.insert(name, comment, start, end, now)
+		except ValueError, e:
+			print e
+			sys.exit(1)
+		print_stopped(changes)
+		for t in removed:
+			print "Remove:", t.name, t.start, t.end
+		for t in inserted:
+			print "Insert:", t.name, t.start, t.end
+	elif options.stop:
+		print_stopped(tracker.stop(now))
 	elif name:
-		stop_timer()
-		start_timer(name, comment)
-	elif options.report:
-		report()
-	elif options.report_cal:
-		report_cal()
-	elif options.report_break_in_service:
-		report_break_in_service()
-	elif len(timers) > 0 and timers[-1].active():
-		d = int(timers[-1].duration().total_seconds() / 60)
-		print "{} {:d}:{:02d}".format(timers[-1].name, d / 60, d % 60)
+		print_stopped(tracker.stop(now))
+		tracker.start(name, comment, now)
+		print "Start:", name, now
+	elif options.archive:
+		tracker.archive(datetime.datetime.strptime(options.archive, "%Y-%m-%d"))
+	elif options.convert:
+		convert(tracker, os.path.expanduser(options.convert))
+	elif options.check or options.repair:
+		# --repair alone checks first too
+		problems = check_timers(tracker.timers)
+		if not tracker.check_rollup():
+			print "Removed", rollup_name(tracker.fname), "because it doesn't have the totals of the timers"
+		for kind, t, other in problems:
+			print kind + ":", t.description()
+			if other:
+				print "  and", other.description()
+		if not problems:
+			print "No problems"
+		elif options.repair:
+			count = len(tracker.timers)
+			for t, start, end in tracker.repair():
+				print "Drop:", t.name, start, end
+			print "Repaired", len(problems), "problems,", count, "timers before and", len(tracker.timers), "after"
+		else:
+			print len(problems), "problems, --repair fixes them"
+			sys.exit(1)
+	elif options.export:
+		since, until = report_range(options, now)
+		filter = report_filter(options)
+		profile.enter("export")
+		if options.export_by == "timer":
+			# Timers are written as they are read, so exporting a big file
+			# doesn't load it
+			records = timer_records(tracker.stream(since, until, options.with_archive, filter))
+			fields = timer_fields
+		else:
+			records = total_records(tracker.report_runs(since, until, options.with_archive, filter), options.export_by)
+			fields = total_fields
+		profile.leave(export(records, fields, options.export, sys.stdout))
+	elif options.report or options.report_cal or options.report_break_in_service:
+		since, until = report_range(options, now)
+		filter = report_filter(options)
+		runs = tracker.report_runs(since, until, options.with_archive, filter)
+		profile.enter("report")
+		if options.report:
+			report(runs)
+		elif options.report_cal:
+			report_cal(runs)
+		else:
+			report_break_in_service(runs)
+		profile.leave(len(runs))
+	elif options.compact:
+		# commit() below folds the journal into the data file
+		pass
+	elif tracker.active():
+		t = tracker.active()
+		d = int(t.duration().total_seconds() / 60)
+		print "{} {:d}:{:02d}".format(t.name, d / 60, d % 60)
 	else:
 		print "No active timer"
-	if save_changes:
-		save(fname)
+	tracker.commit(options.compact)
+
+def print_stopped(changes):
+	"""Print the timers TimeTracker.stop() changed"""
+	for t, start, end in changes:
+		if end == None and start == t.start:
+			print "Stop:", t.name, t.duration()
+		else:
+			print "Adjust:", t.name
+			print "  before", start, end
+			print "   after", t.start, t.end
+
+def parse_time(text, day):
+	"""Return the datetime of YYYY-MM-DD HH:MM, or of HH:MM on day"""
+	for format in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"):
+		try:
+			return datetime.datetime.strptime(text, format)
+		except ValueError:
+			pass
+	try:
+		clock = datetime.datetime.strptime(text, "%H:%M")
+	except ValueError:
+		parser.error("can't read the time " + text + ", use HH:MM or \"YYYY-MM-DD HH:MM\"")
+	return day.replace(hour = clock.hour, minute = clock.minute, second = 0, microsecond = 0)
+
+def report_range(options, now):
+	"""Return the first day and the day after the last day to report, or
+	None when there is no limit"""
+	since = None
+	until = None
+	if options.since:
+		since = datetime.datetime.strptime(options.since, "%Y-%m-%d")
+	if options.last_weeks:
+		monday = now.replace(hour = 0, minute = 0, second = 0) - datetime.timedelta(days = now.weekday())
+		since = monday - datetime.timedelta(weeks = options.last_weeks - 1)
+	if options.until:
+		until = datetime.datetime.strptime(options.until, "%Y-%m-%d") + datetime.timedelta(days = 1)
+	return since, until
+
+def report_filter(options):
+	"""Return the TimerFilter of the --tag and --name options, or None"""
+	if not options.tags and not options.names:
+		return None
+	try:
+		return TimerFilter(options.tags or [], options.names or [])
+	except re.error, e:
+		parser.error("--name: " + str(e))
+	except ValueError, e:
+		parser.error(str(e))
 
 def date_from_str(str):
 	if str == 'None':
@@ -244,120 +1129,2162 @@ def date_to_str(date):
 		return "None"
 	return '{:%Y-%m-%d %H:%M:%S}'.format(date)
 
-def load(fname):
-	global timers, save_changes, font_name, font_size
-	timers = []
-	if options.verbose:
-		print "loading", fname
-	with open(fname, "rb") as f:
-		load_version = 0
-		for line in f:
-			field = line.rstrip('\r\n').split('\t')
-			if field[0] == 'TAGCHAR':
-				tag_char = field[1]
-			elif field[0] == 'FONT':
-				font_name = field[1]
-				font_size = field[2]
-			elif field[0] == 'TIMER':
-				if load_version > 1:
-					start = date_from_str(field[1])
-					stop = date_from_str(field[2])
-					timers.append(Timer(field[3], field[4], start, stop))
-				elif load_version == 1:
-					start = date_from_str(field[1])
-					stop = date_from_str(field[2])
-					timers.append(Timer(field[3], "", start, stop))
-				else:
-					start = date_from_str(field[2])
-					stop = date_from_str(field[3])
-					timers.append(Timer(field[1], "", start, stop))
-			elif field[0] == 'VERSION':
-				load_version = int(field[1])
-		if options.verbose:
-			print "loaded", len(timers), "timers"
-	if load_version != version:
-		save_changes = True
+# Since version 3 times are saved as seconds since 1970-01-01 00:00 of the
+# local clock.  There is no time zone conversion, so it is the same
+# datetime that was saved, and much faster to parse than strptime().
+date_from_seconds = datetime.datetime.utcfromtimestamp
+
+def date_from_secs(str):
+	if str == 'None':
+		return None
+	return date_from_seconds(int(str))
 
-def backup(fname):
+def date_to_secs(date):
+	if date == None:
+		return "None"
+	return str(calendar.timegm(date.timetuple()))
+
+def date_to_field(date):
+	"""Format date for the current version of the data file and journal"""
+	return date_to_secs(date)
+
+def timer_from_fields(field, load_version, tag_char = default_tag_char):
+	if load_version > 2:
+		start = date_from_secs(field[1])
+		stop = date_from_secs(field[2])
+		return Timer(field[3], field[4], start, stop, tag_char)
+	elif load_version > 1:
+		start = date_from_str(field[1])
+		stop = date_from_str(field[2])
+		return Timer(field[3], field[4], start, stop, tag_char)
+	elif load_version == 1:
+		start = date_from_str(field[1])
+		stop = date_from_str(field[2])
+		return Timer(field[3], "", start, stop, tag_char)
+	start = date_from_str(field[2])
+	stop = date_from_str(field[3])
+	return Timer(field[1], "", start, stop, tag_char)
+
+def read_tail_lines(f, offset, count):
+	"""Read backwards from the end of f until there are count lines after
+	offset, or all of them if there are fewer.  Also return whether all of
+	them were read."""
+	f.seek(0, 2)
+	pos = f.tell()
+	block = 4096
+	data = ""
+	while pos > offset and data.count('\n') <= count:
+		size = min(block, pos - offset)
+		pos -= size
+		f.seek(pos)
+		data = f.read(size) + data
+		block *= 2
+	lines = data.split('\n')
+	if pos > offset:
+		# The first line is only part of a line
+		lines = lines[1:]
+	lines = [l for l in lines if l]
+	return lines[-count:], pos <= offset and len(lines) <= count
+
+def journal_name(fname):
+	return fname + ".journal"
+
+def journal_depth(jname):
+	"""Return how many timers from the end of the data file the records of
+	the journal jname may change"""
+	depth = 0
+	# How many more timers there are than in the data file, an index after
+	# a DELETE reaches one timer further back
+	added = 0
+	if os.path.exists(jname):
+		with open(jname, "rb") as f:
+			f.readline()
+			for line in f:
+				if not line.endswith('\n'):
+					break
+				field = line.split('\t')
+				if field[0] != 'START':
+					depth = max(depth, -int(field[1]) - added)
+				if field[0] in ('START', 'INSERT'):
+					added += 1
+				elif field[0] == 'DELETE':
+					added -= 1
+	return depth
+
+def backup(fname, verbose = False):
 	backup_name = fname + ".bak"
 	if os.path.exists(backup_name):
 		# if the new file is smaller than the previous back up, assume
 		# there was an error and don't overwrite the back up.
+		# Sizes of different versions can't be compared, e.g. version 3 is
+		# smaller than version 2.
 		old_stat = os.stat(backup_name)
 		new_stat = os.stat(fname)
-		if old_stat.st_size > new_stat.st_size:
+		if old_stat.st_size > new_stat.st_size and file_version(backup_name) == file_version(fname):
 			print "Abort back up because", backup_name, "is smaller than", fname
 			return
-	if options.verbose:
+	if verbose:
 		print "Back up", fname, "to", backup_name
 	shutil.copyfile(fname, backup_name)
 
-def save(fname):
-	if options.verbose:
-		print "Saving", fname
-	backup(fname)
-	with open(fname, "wb") as f:
-		# VERSION must be first because loading depends on it.
-		f.write('VERSION\t{}\n'.format(version))
-		if tag_char != default_tag_char:
-			f.write('TAGCHAR\t{}'.format(tag_char))
-		if font_name != default_font_name or font_size != default_font_size:
-			f.write('FONT\t{}\t{}'.format(font_name, font_size))
-		for t in timers:
-			start = date_to_str(t.start)
-			stop = date_to_str(t.end)
-			f.write('TIMER\t{}\t{}\t{}\t{}\n'.format(start, stop, t.name, t.comment))
-		if options.verbose:
-			print "saved", len(timers), "timers"
-
-def resolve_name(name):
-	if not options.explicit:
-		# TODO:  Hmm, this would get slow if there are too many.  But I
-		# assume even with thousands it would not be noticable.  Could at
-		# least add a command to archive old timers.
-		for t in reversed(timers):
-			if re.search(name, t.name):
-				name = t.name
-				if options.verbose:
-					print "name matches existing timer"
-				break;
-	if options.verbose:
-		print "Using name:", name
-	return name
-
-def stop_timer():
-	global save_changes, timers
-	if len(timers) == 0:
-		return
-	# Stop current timer if it was running, and adjust existing timers
-	# in case "now" was adjusted by a command line options
-	for i in xrange(len(timers)-1, -1, -1):
-		t = timers[i]
-		if now < t.start:
-			print "Adjust:", t.name
-			print "  before", t.start, t.end
-			t.start = now
-			t.end = now
-			print "   after", t.start, t.end
-			save_changes = True
-		elif t.active():
-			t.end = now
-			print "Stop:", t.name, t.duration()
-			save_changes = True
-		elif now < t.end:
-			print "Adjust:", t.name
-			print "  before", t.start, t.end
-			t.end = now
-			print "   after", t.start, t.end
-			save_changes = True
+def file_version(fname):
+	with open(fname, "rb") as f:
+		field = f.readline().rstrip('\r\n').split('\t')
+	if field[0] == 'VERSION':
+		return int(field[1])
+	return 0
+
+def timer_line(t):
+	start = date_to_field(t.start)
+	stop = date_to_field(t.end)
+	return 'TIMER\t{}\t{}\t{}\t{}\n'.format(start, stop, t.name, t.comment)
+
+# Characters that make a name a regular expression instead of a plain string
+regexp_chars = re.compile(r"[][.^$*+?{}\\|()]")
+
+class NameIndex(object):
+	"""The distinct names of all timers.  Searching them gives the same
+	name as searching all timers from the most recent one."""
+
+	def __init__(self):
+		# Higher rank is more recently used
+		self.rank = {}
+		self.uses = {}
+		self.count = 0
+		# Built by search(), --complete doesn't need them
+		self.trigrams = None
+		self.patterns = {}
+		self.order = None
+
+	def add(self, name, uses = 1, last = None):
+		"""Add uses of name, the last one by timer number last, or the
+		next timer.  A use before the last one, e.g. of a timer inserted in
+		the past, doesn't make name more recent."""
+		if name not in self.rank:
+			self.uses[name] = uses
+			if self.trigrams != None:
+				self.add_trigrams(name)
+		else:
+			self.uses[name] += uses
+		if last == None:
+			self.count += uses
+			last = self.count
 		else:
+			self.count = max(self.count, last)
+		if last > self.rank.get(name, last - 1):
+			self.rank[name] = last
+		self.order = None
+
+	def add_trigrams(self, name):
+		for i in xrange(len(name) - 2):
+			self.trigrams.setdefault(name[i:i+3], set()).add(name)
+
+	def recent(self):
+		"""Return the names, most recently used first"""
+		if self.order == None:
+			self.order = sorted(self.rank, key=self.rank.get, reverse=True)
+		return self.order
+
+	def search(self, name):
+		if regexp_chars.search(name):
+			pat = self.patterns.get(name)
+			if pat == None:
+				pat = re.compile(name)
+				self.patterns[name] = pat
+			for n in self.recent():
+				if pat.search(n):
+					return n
+			return None
+		if len(name) < 3:
+			for n in self.recent():
+				if name in n:
+					return n
+			return None
+		# Only names that have all the trigrams of name can contain it.
+		if self.trigrams == None:
+			self.trigrams = {}
+			for n in self.rank:
+				self.add_trigrams(n)
+		sets = []
+		for i in xrange(len(name) - 2):
+			s = self.trigrams.get(name[i:i+3])
+			if not s:
+				return None
+			sets.append(s)
+		sets.sort(key=len)
+		matches = [n for n in sets[0].intersection(*sets[1:]) if name in n]
+		if not matches:
+			return None
+		return max(matches, key=self.rank.get)
+
+	def complete(self, prefix, tag_char):
+		"""Return the names and tags that start with prefix, the highest
+		score first"""
+		score = {}
+		# Tags start with tag_char
+		tags = not prefix or prefix.startswith(tag_char)
+		pat = tag_pattern(tag_char)
+		for n, rank in self.rank.iteritems():
+			s = self.uses[n] * 0.5 ** (float(self.count - rank) / complete_half_life)
+			if n.startswith(prefix):
+				score[n] = score.get(n, 0) + s
+			if tags:
+				for tag in set(pat.findall(n)):
+					if tag.startswith(prefix):
+						score[tag] = score.get(tag, 0) + s
+		return sorted(score, key=lambda n: (-score[n], n))
+
+class TimerIndex(object):
+	"""The positions of the timers with each tag and each name, in order, so
+	filtering them only looks at the timers that match"""
+
+	def __init__(self):
+		self.timers = None
+		self.count = 0
+		self.tags = {}
+		self.names = {}
+
+	def update(self, timers):
+		"""Add the timers that were appended since the last update, or index
+		them all again when timers is a different list or got shorter"""
+		if timers is not self.timers or len(timers) < self.count:
+			self.timers = timers
+			self.count = 0
+			self.tags = {}
+			self.names = {}
+		tags = self.tags
+		names = self.names
+		for i in xrange(self.count, len(timers)):
+			t = timers[i]
+			for tag in t.tags:
+				p = tags.get(tag)
+				if p == None:
+					p = tags[tag] = array.array('i')
+				p.append(i)
+			p = names.get(t.name)
+			if p == None:
+				p = names[t.name] = array.array('i')
+			p.append(i)
+		self.count = len(timers)
+
+def positions_in(p, lo, hi):
+	"""Return the positions in the sorted p from lo up to hi"""
+	return p[bisect.bisect_left(p, lo):bisect.bisect_left(p, hi)]
+
+class TimerFilter(object):
+	"""Which timers to report.  A timer has to have one of the tags of each
+	group, where a negated tag means not having it, and a name that matches
+	each of the regular expressions of names.  Raises ValueError for a group
+	without tags or an empty name, they would match nothing or everything."""
+
+	def __init__(self, tags, names):
+		# Each --tag is a group of (negated, tag)
+		self.groups = []
+		for option in tags:
+			group = []
+			for tag in option.split(","):
+				tag = tag.strip()
+				if tag.startswith("-"):
+					if tag[1:]:
+						group.append((True, tag[1:]))
+				elif tag:
+					group.append((False, tag))
+			if not group:
+				raise ValueError("--tag {!r} has no tags".format(option))
+			self.groups.append(group)
+		for n in names:
+			if not n:
+				raise ValueError("--name needs a regular expression")
+		self.names = [re.compile(n) for n in names]
+
+	def match(self, t):
+		for group in self.groups:
+			for negated, tag in group:
+				if (tag in t.tags) != negated:
+					break
+			else:
+				return False
+		for pat in self.names:
+			if not pat.search(t.name):
+				return False
+		return True
+
+	def positions(self, index, lo, hi):
+		"""Return the positions of the matching timers from lo up to hi, in
+		order, from the sorted positions in index"""
+		# Sets the positions have to be in, and sets they must not be in
+		include = []
+		exclude = []
+		for group in self.groups:
+			pos = set()
+			neg = None
+			for negated, tag in group:
+				p = positions_in(index.tags.get(tag, ()), lo, hi)
+				if not negated:
+					pos.update(p)
+				elif neg == None:
+					neg = set(p)
+				else:
+					neg.intersection_update(p)
+			# One of the tags, or not all of the negated ones
+			if neg == None:
+				include.append(pos)
+			else:
+				exclude.append(neg - pos)
+		for pat in self.names:
+			pos = set()
+			for name, p in index.names.iteritems():
+				if pat.search(name):
+					pos.update(positions_in(p, lo, hi))
+			include.append(pos)
+		if include:
+			include.sort(key=len)
+			result = include[0].intersection(*include[1:])
+		else:
+			result = set(xrange(lo, hi))
+		for neg in exclude:
+			result.difference_update(neg)
+		return sorted(result)
+
+def names_name(fname):
+	return fname + ".names"
+
+def archive_name(fname):
+	return fname + ".archive"
+
+def segment_name(fname, month):
+	return fname + "." + month
+
+def read_manifest(fname):
+	"""Return the archived segments, oldest first, as tuples of (month,
+	count, first start, last start)"""
+	segments = []
+	aname = archive_name(fname)
+	if os.path.exists(aname):
+		with open(aname, "rb") as f:
+			for line in f:
+				field = line.rstrip('\r\n').split('\t')
+				if field[0] == 'SEGMENT':
+					segments.append((field[1], int(field[2]), date_from_secs(field[3]), date_from_secs(field[4])))
+	segments.sort()
+	return segments
+
+def read_archived_names(fname):
+	"""Return the names of the archived timers as a NameIndex, or None when
+	the archive was made before it listed them"""
+	index = NameIndex()
+	segments = False
+	aname = archive_name(fname)
+	if os.path.exists(aname):
+		with open(aname, "rb") as f:
+			for line in f:
+				field = line.rstrip('\r\n').split('\t')
+				if field[0] == 'SEGMENT':
+					segments = True
+				elif field[0] == 'NAME':
+					index.add(field[1], int(field[2]), int(field[3]))
+	if segments and not index.rank:
+		return None
+	return index
+
+def write_manifest(fname, segments, names):
+	"""Write the segments and the NameIndex of the archived timers"""
+	with replacing(archive_name(fname)) as f:
+		for month, count, first, last in segments:
+			f.write('SEGMENT\t{}\t{}\t{}\t{}\n'.format(month, count, date_to_secs(first), date_to_secs(last)))
+		for n in reversed(names.recent()):
+			f.write('NAME\t{}\t{}\t{}\n'.format(n, names.uses[n], names.rank[n]))
+
+def find_start(timers, date):
+	"""Return the index of the first timer that started on or after date,
+	the timers have to be in order."""
+	lo = 0
+	hi = len(timers)
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if timers[mid].start < date:
+			lo = mid + 1
+		else:
+			hi = mid
+	return lo
+
+def check_timers(timers):
+	"""Return the problems with timers as a list of (problem, timer, other
+	timer or None).  The timers are sorted by start, so any that overlap are
+	found by comparing each with the one that ends last of those before it."""
+	problems = []
+	prev = None
+	active = 0
+	for t in timers:
+		if prev and t.start < prev.start:
+			problems.append(("Out of order", t, prev))
+		if t.active():
+			active += 1
+			if active == 2:
+				problems.append(("More than one active timer", t, None))
+		elif t.end == t.start:
+			problems.append(("No time", t, None))
+		elif t.end < t.start:
+			problems.append(("Ends before it starts", t, None))
+		prev = t
+	last = None
+	for t in sorted(timers, key = lambda t: t.start):
+		if last and (last.active() or last.end > t.start) and (t.active() or t.end > t.start):
+			problems.append(("Overlap", last, t))
+		if last == None or not last.active() and (t.active() or t.end > last.end):
+			last = t
+	return problems
+
+def repair_timers(timers, tag_char = default_tag_char):
+	"""Return the timers sorted by start, each ending where the next one
+	starts, without the ones that are left without time.  A timer that
+	encloses another continues after it, so only time that two timers both
+	have is dropped.  Also return what was dropped as a list of (timer,
+	start, end)."""
+	repaired = []
+	dropped = []
+	# By start, and by position for timers that start at the same time.  The
+	# rest of an enclosing timer is added after the others.
+	pending = [(t.start, i, t) for i, t in enumerate(timers)]
+	heapq.heapify(pending)
+	count = len(pending)
+	while pending:
+		start, i, t = heapq.heappop(pending)
+		if t.end != None and t.end <= t.start:
+			continue
+		if repaired:
+			prev = repaired[-1]
+			if prev.active() or prev.end > t.start:
+				if t.active():
+					end = prev.end
+				elif prev.active() or prev.end > t.end:
+					end = t.end
+					rest = Timer(prev.name, prev.comment, t.end, prev.end, tag_char)
+					heapq.heappush(pending, (rest.start, count, rest))
+					count += 1
+				else:
+					end = prev.end
+				if end != None:
+					dropped.append((prev, t.start, end))
+				prev.end = t.start
+				if prev.end == prev.start:
+					repaired.pop()
+		repaired.append(t)
+	return repaired, dropped
+
+def range_bounds(timers, since, until):
+	"""Return the positions of the first timer that started on or after since
+	and of the first one on or after until, the timers have to be in order"""
+	lo = 0
+	hi = len(timers)
+	if since:
+		lo = find_start(timers, since)
+	if until:
+		hi = find_start(timers, until)
+	return lo, hi
+
+def select_range(timers, since, until):
+	lo, hi = range_bounds(timers, since, until)
+	return timers[lo:hi]
+
+def in_range(start, since, until):
+	"""Return whether start is from since up to until, the same as
+	select_range() picks"""
+	return (since == None or start >= since) and (until == None or start < until)
+
+def archived_segments(fname, since, until):
+	"""Return the months of the archived segments of fname that may have
+	timers that started from since up to until"""
+	return [month for month, count, first, last in read_manifest(fname)
+			if not (since and last < since) and not (until and first >= until)]
+
+def day_runs(timers):
+	"""Return the totals of each run of timers that started on the same day,
+	as a list of (date, total).  timers can be any iterable, only a list is
+	added up with numpy."""
+	if isinstance(timers, list) and len(timers) >= numpy_threshold:
+		try:
+			import numpy
+		except ImportError:
+			numpy = None
+		if numpy:
+			return day_runs_numpy(timers, numpy)
+	runs = []
+	prev_day = None
+	for t in timers:
+		day = t.start.toordinal()
+		if day != prev_day:
+			total = ({}, {})
+			runs.append((t.start.date(), total))
+			prev_day = day
+		add_duration(t, total)
+	return runs
+
+def join_runs(runs, more):
+	"""Return runs followed by more, the same as day_runs() of their timers"""
+	if runs and more and runs[-1][0] == more[0][0]:
+		add_totals(more[0][1], runs[-1][1])
+		more = more[1:]
+	return runs + more
+
+# The timers parallel_day_runs() adds up, the worker processes get them when
+# they are forked
+forked_timers = None
+
+def range_runs(bounds):
+	lo, hi = bounds
+	return day_runs(forked_timers[lo:hi])
+
+def parallel_day_runs(timers, jobs):
+	"""Return day_runs(timers), added up by a pool of jobs processes that
+	each take some months of them.  The processes are forked with the
+	timers, so only their runs are sent back."""
+	if jobs < 2 or len(timers) < parallel_threshold or not hasattr(os, "fork") or not in_order(timers):
+		return day_runs(timers)
+	# About four parts per process, each up to the start of a month, so no
+	# day or week is split.  Weeks end with the month in reports.
+	size = len(timers) // (jobs * 4) + 1
+	bounds = []
+	lo = 0
+	while lo < len(timers):
+		hi = lo + size
+		if hi < len(timers):
+			t = timers[hi - 1].start
+			hi = find_start(timers, datetime.datetime(t.year + t.month // 12, t.month % 12 + 1, 1))
+		else:
+			hi = len(timers)
+		bounds.append((lo, hi))
+		lo = hi
+	global forked_timers
+	forked_timers = timers
+	try:
+		import multiprocessing
+		pool = multiprocessing.Pool(min(jobs, len(bounds)))
+		try:
+			run_lists = pool.map(range_runs, bounds)
+		finally:
+			pool.close()
+	finally:
+		forked_timers = None
+	return list(itertools.chain(*run_lists))
+
+def segment_runs(args):
+	"""Return the day runs of an archived segment, for a worker process"""
+	fname, month, tag_char, since, until, filter = args
+	tracker = TimeTracker(fname)
+	tracker.tag_char = tag_char
+	timers = select_range(tracker.load_segment(month), since, until)
+	if filter != None:
+		timers = [t for t in timers if filter.match(t)]
+	return day_runs(timers)
+
+def day_runs_numpy(timers, np):
+	"""Same as day_runs(), but add up the durations with numpy"""
+	epoch = datetime.datetime(1970, 1, 1)
+	now = datetime.datetime.now().replace(microsecond=0)
+	n = len(timers)
+	start = np.fromiter(((t.start - epoch).total_seconds() for t in timers), dtype=np.float64, count=n)
+	end = np.fromiter((((t.end or now) - epoch).total_seconds() for t in timers), dtype=np.float64, count=n)
+	start = start.astype(np.int64)
+	end = end.astype(np.int64)
+	# Names and tag sets are shared by timers with the same name, see
+	# shared_name(), so their id() is a cheap code for them.
+	ids, first, name = np.unique(np.array([id(t.name) for t in timers]), return_index=True, return_inverse=True)
+	names = [timers[i].name for i in first.tolist()]
+	ids, first, tag_set = np.unique(np.array([id(t.tags) for t in timers]), return_index=True, return_inverse=True)
+	tag_sets = [timers[i].tags for i in first.tolist()]
+	tag_codes = {}
+	for ts in tag_sets:
+		for tag in ts:
+			tag_codes.setdefault(tag, len(tag_codes))
+	tags = [None] * len(tag_codes)
+	for k, v in tag_codes.iteritems():
+		tags[v] = k
+	# membership[s, t] is true when tag set s has tag t
+	membership = np.zeros((len(tag_sets), len(tags)), dtype=bool)
+	for code in xrange(len(tag_sets)):
+		for tag in tag_sets[code]:
+			membership[code, tag_codes[tag]] = True
+
+	duration = (end - start).astype(np.float64)
+	day = start // 86400
+	new_run = np.empty(n, dtype=bool)
+	new_run[0] = True
+	new_run[1:] = day[1:] != day[:-1]
+	run = np.cumsum(new_run) - 1
+	runs = []
+	for d in day[new_run]:
+		runs.append((datetime.date.fromordinal(int(d) + epoch.toordinal()), ({}, {})))
+
+	# Name totals per run
+	keys, inverse = np.unique(run * len(names) + name, return_inverse=True)
+	sums = np.bincount(inverse, weights=duration)
+	for k, sec in zip(keys.tolist(), sums.tolist()):
+		r, code = divmod(k, len(names))
+		runs[r][1][0][names[code]] = datetime.timedelta(seconds = int(sec))
+
+	# Totals per run and tag set, then spread over the tags of each set
+	keys, inverse = np.unique(run * len(tag_sets) + tag_set, return_inverse=True)
+	sums = np.bincount(inverse, weights=duration)
+	set_run, set_code = np.divmod(keys, len(tag_sets))
+	row, tag = np.nonzero(membership[set_code])
+	keys, inverse = np.unique(set_run[row] * len(tags) + tag, return_inverse=True)
+	sums = np.bincount(inverse, weights=sums[row])
+	for k, sec in zip(keys.tolist(), sums.tolist()):
+		r, code = divmod(k, len(tags))
+		runs[r][1][1][tags[code]] = datetime.timedelta(seconds = int(sec))
+	return runs
+
+def in_order(timers):
+	for i in xrange(1, len(timers)):
+		if timers[i].start < timers[i-1].start:
+			return False
+	return True
+
+def rollup_name(fname):
+	return fname + ".rollup"
+
+def write_runs(f, runs, upto):
+	for date, total in runs:
+		f.write('RUN\t{}\n'.format(date.toordinal()))
+		for n, d in total[0].iteritems():
+			f.write('N\t{}\t{}\n'.format(d.days * 86400 + d.seconds, n))
+		for n, d in total[1].iteritems():
+			f.write('T\t{}\t{}\n'.format(d.days * 86400 + d.seconds, n))
+	f.write('UPTO\t{}\n'.format(date_to_secs(upto)))
+
+def rollup_header(tag_char, fname):
+	"""Return the first line of the rollup cache for the data file fname as
+	it is now"""
+	st = os.stat(fname)
+	# A fixed width, so save() can write it over the old one
+	return 'ROLLUP\t{}\t{:020d}\t{:<24}\n'.format(tag_char, st.st_size, repr(st.st_mtime))
+
+def find_run(f, lo, hi, day):
+	"""Return the offset of the last RUN line of the rollup cache f that is
+	before day, or lo when there is none.  lo is the start of a line, and the
+	RUN lines from there up to hi are in order."""
+	while hi - lo > 65536:
+		mid = (lo + hi) // 2
+		# Starting one before mid finds a RUN line that starts at mid
+		f.seek(mid - 1)
+		f.readline()
+		pos = f.tell()
+		line = f.readline()
+		while line.endswith('\n') and not line.startswith('RUN\t'):
+			pos = f.tell()
+			line = f.readline()
+		if line.startswith('RUN\t') and line.endswith('\n') and int(line.split('\t')[1]) < day:
+			lo = pos
+		else:
+			hi = mid
+	f.seek(lo)
+	pos = lo
+	found = lo
+	while pos < hi:
+		line = f.readline()
+		if not line.endswith('\n'):
 			break
+		if line.startswith('RUN\t'):
+			if int(line.split('\t')[1]) >= day:
+				break
+			found = pos
+		pos += len(line)
+	return found
+
+def remove_rollup(fname):
+	rname = rollup_name(fname)
+	if os.path.exists(rname):
+		os.remove(rname)
+
+def final_day(timers):
+	"""Return the start of the first day that can still change.  That is
+	today, or the day an active timer started."""
+	final = datetime.datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+	for t in timers:
+		if t.active() and t.start < final:
+			final = t.start.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+	return final
+
+class TimeTracker(object):
+	"""The timers of one data file, with its journal, name index, archive and
+	rollup cache.  Changes stay in memory until commit() writes them, so a
+	program can load once and make many changes.  Other tt commands may run
+	at the same time, hold locked() from loading until commit()."""
+
+	def __init__(self, fname = "~/.timetracker", verbose = False):
+		self.fname = os.path.expanduser(fname)
+		self.verbose = verbose
+		self.timers = []
+		self.save_changes = False
+		self.journal_gen = 0
+		self.journal_length = None
+		self.journal_events = []
+		# The size of the journal records that were replayed or appended, the
+		# GUI replays the journal from there when another tt appended to it.
+		self.journal_offset = 0
+		# False after load_tail() until the rest is loaded
+		self.timers_complete = True
+		# Distinct names for resolve(), read from the .names file when
+		# needed.  new_names are appended to that file with the journal, as
+		# (name, timer number) or (name, None) for the next timer.
+		self.name_index = None
+		self.new_names = []
+		# The earliest start of a timer that was changed, the rollup cache is
+		# invalidated from that day on.
+		self.changed_since = None
+		# True in the daemon and the GUI, which keep all timers in memory
+		self.resident = False
+		# file_state() of the data file when it was loaded, to notice when it
+		# changed
+		self.loaded_state = None
+		# True while locked() holds the shared lock, commit() doesn't write
+		# then
+		self.shared_lock = False
+		# Built by select() when filtering in the daemon or the GUI
+		self.timer_index = None
+		# Processes to add up reports with, see --jobs
+		self.jobs = 1
+		self.tag_char = default_tag_char
+		self.font_name = default_font_name
+		self.font_size = default_font_size
+
+	@contextlib.contextmanager
+	def locked(self, exclusive = True):
+		"""Hold the lock of the data file, shared when only reading"""
+		lock = lock_file(self.fname, exclusive, self.verbose)
+		shared = self.shared_lock
+		self.shared_lock = not exclusive
+		try:
+			yield self
+		finally:
+			self.shared_lock = shared
+			unlock_file(lock)
+
+	def clear(self):
+		"""Forget all timers, as if loading an empty file"""
+		self.timers = []
+		self.timers_complete = True
+		self.name_index = None
+		self.journal_gen = 0
+		self.journal_length = None
+
+	def forget_changes(self):
+		"""Forget the changes that were not written by commit().  An upgrade
+		of the data file is kept for the next commit() that may write."""
+		self.journal_events = []
+		self.new_names = []
+		self.changed_since = None
+
+	def load_setting(self, field):
+		if field[0] == 'TAGCHAR':
+			self.tag_char = field[1]
+		elif field[0] == 'FONT':
+			self.font_name = field[1]
+			self.font_size = field[2]
+		elif field[0] == 'JOURNAL':
+			self.journal_gen = int(field[1])
+
+	@profiled("load", lambda result, self: len(self.timers))
+	def load(self):
+		"""Load all timers and replay the journal"""
+		self.loaded_state = file_state(self.fname)
+		self.timers = []
+		self.name_index = None
+		self.timers_complete = True
+		self.journal_gen = 0
+		if self.verbose:
+			print "loading", self.fname
+		load_version = self.load_file(self.fname, self.timers)
+		self.replay_journal()
+		if self.verbose:
+			print "loaded", len(self.timers), "timers"
+		if load_version != version:
+			self.save_changes = True
+
+	def load_file(self, fname, timers):
+		"""Append the timers of the data file or archived segment fname to
+		timers, and return its version"""
+		with open(fname, "rb") as f, collector_paused():
+			load_version, offset = self.load_header(f)
+			f.seek(offset)
+			if load_version == 3:
+				self.load_timers_v3(f, timers)
+			else:
+				for line in f:
+					field = line.rstrip('\r\n').split('\t')
+					if field[0] == 'TIMER':
+						timers.append(timer_from_fields(field, load_version, self.tag_char))
+					else:
+						self.load_setting(field)
+		return load_version
+
+	def load_header(self, f):
+		"""Read the version and settings at the top of the file, up to the
+		first timer.  Return the version and the offset of the first timer."""
+		load_version = 0
+		while True:
+			offset = f.tell()
+			line = f.readline()
+			if not line or line.startswith('TIMER\t'):
+				return load_version, offset
+			field = line.rstrip('\r\n').split('\t')
+			if field[0] == 'VERSION':
+				load_version = int(field[1])
+			else:
+				self.load_setting(field)
+
+	def load_timers_v3(self, f, timers):
+		# This is the same as timer_from_fields(), but inlined because it is
+		# most of the time spent loading a large file.  The comment is the
+		# last field, it still has the end of the line.
+		append = timers.append
+		new = Timer.__new__
+		from_seconds = date_from_seconds
+		tag_char = self.tag_char
+		# The shared names of the raw name and comment fields, so most
+		# timers don't call shared_name()
+		names = {}
+		# A timer usually starts when the previous one ended, so share that
+		# datetime too.
+		prev_end = None
+		prev_date = None
+		for line in f:
+			field = line.split('\t')
+			if field[0] != 'TIMER':
+				field[-1] = field[-1].rstrip('\r\n')
+				self.load_setting(field)
+				tag_char = self.tag_char
+				names = {}
+				continue
+			t = new(Timer)
+			key = (field[3], field[4])
+			shared = names.get(key)
+			if shared == None:
+				shared = shared_name(field[3], field[4].rstrip('\r\n'), tag_char)
+				names[key] = shared
+			t.name, t.comment, t.tags = shared
+			start = field[1]
+			if start == prev_end:
+				t.start = prev_date
+			else:
+				t.start = from_seconds(int(start))
+			end = field[2]
+			if end == 'None':
+				t.end = None
+			else:
+				prev_end = end
+				t.end = prev_date = from_seconds(int(end))
+			append(t)
+
+	@profiled("load", lambda result, self, *args: len(self.timers))
+	def load_tail(self, count):
+		"""Load the settings and only the last count timers.  Return False
+		if that is not enough, e.g. the file needs an upgrade or the journal
+		changes older timers, and a full load() is needed."""
+		self.loaded_state = file_state(self.fname)
+		self.timers = []
+		self.name_index = None
+		self.journal_gen = 0
+		if self.verbose:
+			print "loading last", count, "timers of", self.fname
+		with open(self.fname, "rb") as f:
+			load_version, offset = self.load_header(f)
+			if load_version != version:
+				return False
+			lines, self.timers_complete = read_tail_lines(f, offset, count)
+			for line in lines:
+				field = line.rstrip('\r').split('\t')
+				if field[0] == 'TIMER':
+					self.timers.append(timer_from_fields(field, load_version, self.tag_char))
+		if not self.replay_journal():
+			return False
+		if self.verbose:
+			print "loaded", len(self.timers), "timers"
+		return True
+
+	def load_since(self, since):
+		"""Load the timers that started on or after since, and at least one
+		before that, with load_tail()"""
+		count = tail_length
+		while self.load_tail(count):
+			if self.timers_complete or self.timers[0].start < since:
+				return True
+			count *= 2
+		return False
+
+	def load_all(self):
+		"""Load all timers when only some or none were loaded yet"""
+		if self.timers_complete and self.loaded_state != None:
+			return
+		if os.path.exists(self.fname):
+			self.reload()
+
+	def require(self, since = None):
+		"""Make sure the timers that started on or after since are in memory,
+		or all of them without since"""
+		if self.resident or (self.timers_complete and self.loaded_state != None):
+			return
+		if not os.path.exists(self.fname):
+			return
+		if since != None and self.loaded_state != None and self.timers and self.timers[0].start < since:
+			return
+		# Timers that were loaded already may have changes that were not
+		# written yet, those are applied again by reload()
+		if since == None or self.journal_events or not self.load_since(since):
+			self.reload()
+
+	def require_tail(self):
+		"""Make sure at least the last timers are in memory, with load_tail()
+		when nothing was loaded yet.  Everything that changes timers needs
+		them, and the journal generation with them."""
+		if self.resident or self.loaded_state != None or not os.path.exists(self.fname):
+			return
+		if not self.load_tail(tail_length):
+			self.load()
+
+	def reload(self):
+		"""Load all timers again and apply the changes that were not written
+		yet to them"""
+		events = self.journal_events
+		if os.path.exists(self.fname):
+			self.load()
+		else:
+			self.clear()
+		for e in events:
+			self.replay_record(e.split('\t'), date_from_secs)
+		self.journal_events = events
+
+	def merge(self):
+		"""Apply the changes to the data file as it is now.  Something changed
+		it without taking the lock since it was loaded."""
+		print self.fname, "was changed by something else, applying the changes to it"
+		self.reload()
+
+	def replay_journal(self, offset = 0, changes = None):
+		"""Replay the journal, or only the records after offset when the ones
+		before it were replayed already.  The index of each timer that is
+		changed or added is appended to changes.  Return False when a record
+		is for a timer before the ones load_tail() read."""
+		if not offset:
+			self.journal_length = None
+			self.journal_offset = 0
+		jname = journal_name(self.fname)
+		if not os.path.exists(jname):
+			return True
+		with open(jname, "rb") as f:
+			line = f.readline()
+			field = line.rstrip('\r\n').split('\t')
+			if not line.endswith('\n') or field[0] != 'JOURNAL' or int(field[1]) != self.journal_gen:
+				if self.verbose:
+					print "ignoring stale journal", jname
+				return True
+			# Journals from before the size was written aren't checked
+			if len(field) > 3 and int(field[3]) != os.path.getsize(self.fname):
+				print >>sys.stderr, "Ignoring", jname, "because", self.fname, "was edited since it was written"
+				return True
+			# The journal has the date format of its version
+			if int(field[2]) > 2:
+				date_from_field = date_from_secs
+			else:
+				date_from_field = date_from_str
+			if offset:
+				f.seek(offset)
+			else:
+				self.journal_length = 0
+				offset = len(line)
+			for line in f:
+				# A record without a newline was cut short by a crash.
+				if not line.endswith('\n'):
+					break
+				field = line.rstrip('\r\n').split('\t')
+				if field[0] != 'START' and -int(field[1]) > len(self.timers):
+					# The record is for a timer before the ones load_tail() read.
+					return False
+				i = self.replay_record(field, date_from_field)
+				if changes != None:
+					changes.append(i)
+				self.journal_length += 1
+				offset += len(line)
+		self.journal_offset = offset
+		if self.verbose:
+			print "replayed", self.journal_length, "journal records"
+		return True
+
+	def replay_record(self, field, date_from_field):
+		"""Apply a journal record to timers and return the index of the timer"""
+		timers = self.timers
+		if field[0] == 'START':
+			timers.append(Timer(field[2], field[3], date_from_field(field[1]), None, self.tag_char))
+			return len(timers) - 1
+		i = len(timers) + int(field[1])
+		if field[0] == 'INSERT':
+			timers.insert(i, Timer(field[4], field[5], date_from_field(field[2]), date_from_field(field[3]), self.tag_char))
+			# The positions after it changed
+			self.timer_index = None
+			return i
+		if field[0] == 'DELETE':
+			del timers[i]
+			self.timer_index = None
+			return i
+		t = timers[i]
+		if field[0] == 'STOP':
+			t.end = date_from_field(field[2])
+		elif field[0] == 'ADJUST':
+			t.start = date_from_field(field[2])
+			t.end = date_from_field(field[3])
+		return i
+
+	def journal_event(self, *field):
+		self.journal_events.append("\t".join(field))
+
+	@profiled("save", lambda count, *args: count)
+	def append_journal(self):
+		jname = journal_name(self.fname)
+		if self.loaded_state == None and os.path.exists(self.fname):
+			# journal_gen is only known after loading, a journal of the wrong
+			# generation would replace the real one
+			raise RuntimeError("Can't append to the journal of " + self.fname + " without loading it")
+		if self.verbose:
+			print "Appending", len(self.journal_events), "records to", jname
+		# Start a new journal when there was none or it was stale.
+		if self.journal_length == None:
+			mode = "wb"
+			self.journal_length = 0
+		else:
+			mode = "ab"
+		data = "".join([e + "\n" for e in self.journal_events])
+		with open(jname, mode) as f:
+			if mode == "wb":
+				# The size ties the journal to the data file as it is now
+				header = 'JOURNAL\t{}\t{}\t{}\n'.format(self.journal_gen, version, os.path.getsize(self.fname))
+				f.write(header)
+				self.journal_offset = len(header)
+			else:
+				# Drop a record that was cut short by a crash, the new ones
+				# would continue its line
+				f.seek(0, 2)
+				if f.tell() > self.journal_offset:
+					if self.verbose:
+						print "Removing an incomplete record from", jname
+					f.truncate(self.journal_offset)
+			f.write(data)
+		self.journal_offset += len(data)
+		self.loaded_state = file_state(self.fname)
+		count = len(self.journal_events)
+		self.journal_length += count
+		self.journal_events = []
+		self.append_name_index()
+		return count
+
+	@profiled("save", lambda result, self: len(self.timers))
+	def save(self):
+		"""Write all timers to the data file and remove the journal"""
+		fname = self.fname
+		if self.verbose:
+			print "Saving", fname
+		# The rollup cache goes on with the new file when it was for this one
+		rname = rollup_name(fname)
+		cached = None
+		if os.path.exists(fname):
+			cached = rollup_header(self.tag_char, fname)
+			backup(fname, self.verbose)
+		self.journal_gen += 1
+		with replacing(fname) as f:
+			# VERSION must be first because loading depends on it.
+			f.write('VERSION\t{}\n'.format(version))
+			f.write('JOURNAL\t{}\n'.format(self.journal_gen))
+			if self.tag_char != default_tag_char:
+				f.write('TAGCHAR\t{}\n'.format(self.tag_char))
+			if self.font_name != default_font_name or self.font_size != default_font_size:
+				f.write('FONT\t{}\t{}\n'.format(self.font_name, self.font_size))
+			for t in self.timers:
+				f.write(timer_line(t))
+			if self.verbose:
+				print "saved", len(self.timers), "timers"
+		if os.path.exists(rname):
+			moved = False
+			with open(rname, "r+b") as f:
+				if cached != None and f.readline() == cached:
+					f.seek(0)
+					f.write(rollup_header(self.tag_char, fname))
+					moved = True
+			if not moved:
+				if self.verbose:
+					print "Removing", rname, "because", fname, "was edited"
+				remove_rollup(fname)
+		# The journal is folded into the file now.  If removing it fails it is
+		# still ignored because journal_gen changed.
+		jname = journal_name(fname)
+		if os.path.exists(jname):
+			os.remove(jname)
+		self.save_changes = False
+		self.journal_length = None
+		self.journal_offset = 0
+		self.journal_events = []
+		self.loaded_state = file_state(fname)
+		self.save_name_index()
+		self.new_names = []
+
+	def commit(self, compact = False):
+		"""Write the changes.  They are appended to the journal, unless the
+		data file needs to be saved anyway or compact is True."""
+		fname = self.fname
+		if self.shared_lock and not self.journal_events and not compact:
+			# Other commands may be reading the file, upgrading it waits for
+			# a command that changes timers.  Reports still write the rollup
+			# cache, it has a lock of its own.
+			return
+		if compact:
+			# Also rebuild the cache, in case the file was edited by hand
+			remove_rollup(fname)
+		if self.changed_since:
+			self.invalidate_rollup()
+		if ((self.journal_events or self.save_changes or compact)
+				and self.loaded_state != None and self.loaded_state != file_state(fname)):
+			self.merge()
+		if self.save_changes or compact or (self.journal_events and not os.path.exists(fname)):
+			# save() writes all timers, not only the ones loaded
+			self.load_all()
+			self.save()
+		elif self.journal_events:
+			self.append_journal()
+			if self.journal_length > journal_limit:
+				self.load_all()
+				self.save()
+
+	@profiled("resolve", lambda result, *args: 1)
+	def resolve(self, name):
+		"""Return the most recently used name that contains name, or matches
+		it as a regular expression, or name itself when there is none"""
+		if self.name_index == None:
+			self.load_name_index()
+		match = self.name_index.search(name)
+		if match:
+			name = match
+			if self.verbose:
+				print "name matches existing timer"
+		return name
+
+	def complete(self, prefix):
+		"""Return the names and tags that start with prefix, the most used
+		first"""
+		if self.name_index == None:
+			if self.loaded_state == None and os.path.exists(self.fname):
+				# Only the JOURNAL line is needed to check the name index
+				with open(self.fname, "rb") as f:
+					self.load_header(f)
+				self.timers_complete = False
+			self.load_name_index()
+		return self.name_index.complete(prefix, self.tag_char)
+
+	@profiled("names")
+	def load_name_index(self):
+		"""Read the name index, or build it from all timers when it is missing
+		or belongs to an older data file."""
+		nname = names_name(self.fname)
+		if os.path.exists(nname):
+			index = NameIndex()
+			# The archived timers are counted too, an index from before they
+			# were is rebuilt
+			archived = sum([s[1] for s in read_manifest(self.fname)])
+			with open(nname, "rb") as f:
+				valid = False
+				for line in f:
+					if not line.endswith('\n'):
+						break
+					field = line.rstrip('\r\n').split('\t')
+					if field[0] == 'NAMES':
+						valid = int(field[1]) == self.journal_gen and int((field[2:] or [0])[0]) == archived
+						if not valid:
+							break
+					elif field[0] == 'NAME':
+						if len(field) > 3:
+							index.add(field[1], int(field[2]), int(field[3]))
+						else:
+							index.add(field[1])
+			if valid:
+				self.name_index = index
+				return
+		if self.verbose:
+			print "Building name index", nname
+		self.load_all()
+		if os.path.exists(self.fname):
+			self.save_name_index()
+		else:
+			self.name_index = NameIndex()
+			for t in self.timers:
+				self.name_index.add(t.name)
+
+	def save_name_index(self):
+		"""Write the name index of the archived timers and the timers, and
+		use it"""
+		index = self.archived_names()
+		archived = index.count
+		for t in self.timers:
+			index.add(t.name)
+		with replacing(names_name(self.fname)) as f:
+			f.write('NAMES\t{}\t{}\n'.format(self.journal_gen, archived))
+			for n in reversed(index.recent()):
+				f.write('NAME\t{}\t{}\t{}\n'.format(n, index.uses[n], index.rank[n]))
+		self.name_index = index
+
+	def append_name_index(self):
+		nname = names_name(self.fname)
+		# It is rebuilt when it is missing
+		if self.new_names and os.path.exists(nname):
+			with open(nname, "ab") as f:
+				f.write("".join(['NAME\t{}\n'.format(n) if last == None else 'NAME\t{}\t1\t{}\n'.format(n, last)
+								 for n, last in self.new_names]))
+		self.new_names = []
+
+	@profiled("load", lambda segment, *args: len(segment))
+	def load_segment(self, month):
+		segment = []
+		self.load_file(segment_name(self.fname, month), segment)
+		if self.verbose:
+			print "loaded", len(segment), "archived timers from", month
+		return segment
+
+	def load_archive(self, since = None, until = None):
+		"""Load the archived timers that started in [since, until), only
+		opening the segments that have some"""
+		return list(self.iter_archive(since, until))
+
+	def archived_names(self):
+		"""Return the NameIndex of the archived timers.  An archive that
+		doesn't list them yet is read once and listed."""
+		index = read_archived_names(self.fname)
+		if index == None:
+			if self.verbose:
+				print "Listing the names of", archive_name(self.fname)
+			index = NameIndex()
+			for t in self.iter_archive():
+				index.add(t.name)
+			write_manifest(self.fname, read_manifest(self.fname), index)
+		return index
+
+	def archive(self, before):
+		"""Move the timers that started before before to the archive"""
+		fname = self.fname
+		self.load_all()
+		timers = self.timers
+		# Only archive the oldest timers so what is left is still in order.
+		count = 0
+		for t in timers:
+			if t.active() or t.start >= before:
+				break
+			count += 1
+		if count == 0:
+			print "No timers to archive"
+			return
+		segments = dict([(s[0], s) for s in read_manifest(fname)])
+		# The archived names go on counting from the ones archived before
+		names = self.archived_names()
+		for t in timers[:count]:
+			names.add(t.name)
+		for month, group in itertools.groupby(timers[:count], lambda t: '{:%Y-%m}'.format(t.start)):
+			group = list(group)
+			sname = segment_name(fname, month)
+			new_segment = not os.path.exists(sname)
+			with open(sname, "ab") as f:
+				if new_segment:
+					f.write('VERSION\t{}\n'.format(version))
+				f.write("".join([timer_line(t) for t in group]))
+			first = group[0].start
+			last = group[-1].start
+			if month in segments:
+				old_month, old_count, old_first, old_last = segments[month]
+				segments[month] = (month, old_count + len(group), min(first, old_first), max(last, old_last))
+			else:
+				segments[month] = (month, len(group), first, last)
+			print "Archived", len(group), "timers to", sname
+		write_manifest(fname, sorted(segments.values()), names)
+		del timers[:count]
+		self.timer_index = None
+		self.save()
+		# The cache has the days that were archived
+		remove_rollup(fname)
+
+	def repair(self):
+		"""Replace the timers with repair_timers() of all of them and return
+		what it dropped"""
+		self.load_all()
+		self.timers, dropped = repair_timers(self.timers, self.tag_char)
+		self.timer_index = None
+		self.save()
+		# Days anywhere in the file may have changed
+		remove_rollup(self.fname)
+		return dropped
+
+	def read_rollup(self, since = None, until = None):
+		"""Return the cached day runs from since up to until, the time up to
+		which the cache has all timers, and whether some of them were
+		invalidated.  Return None when there is no usable cache.  The runs
+		are in order of day, so with since the file is read from the last
+		run before it on."""
+		rname = rollup_name(self.fname)
+		if not os.path.exists(rname):
+			return None
+		with open(rname, "rb") as f:
+			# Tags depend on the tag character, and the totals on the data
+			# file not being edited since
+			if f.readline() != rollup_header(self.tag_char, self.fname):
+				return None
+			start = f.tell()
+			if since:
+				offset = find_run(f, start, os.fstat(f.fileno()).st_size, since.toordinal())
+				rollup = self.read_runs(f, offset, since, until)
+				# The UPTO for the runs before offset may be before it
+				if rollup != None or offset == start:
+					return rollup
+			return self.read_runs(f, start, since, until)
+
+	def read_runs(self, f, offset, since, until):
+		"""Read the runs of the rollup cache f from offset on for
+		read_rollup().  The totals of runs outside of since and until are
+		skipped."""
+		first = since and since.toordinal()
+		last = until and until.toordinal()
+		runs = []
+		pending = []
+		upto = None
+		invalidated = False
+		total = None
+		in_run = False
+		f.seek(offset)
+		for line in f:
+			if not line.endswith('\n'):
+				break
+			if total == None and line.startswith(('N\t', 'T\t')):
+				if not in_run:
+					# Totals without a day, the cache is broken
+					return None
+				# A run outside of since and until
+				continue
+			field = line.rstrip('\r\n').split('\t')
+			if field[0] == 'N':
+				total[0][field[2]] = datetime.timedelta(seconds = int(field[1]))
+			elif field[0] == 'T':
+				total[1][field[2]] = datetime.timedelta(seconds = int(field[1]))
+			elif field[0] == 'RUN':
+				in_run = True
+				day = int(field[1])
+				if (first and day < first) or (last and day >= last):
+					total = None
+				else:
+					total = ({}, {})
+					pending.append((datetime.date.fromordinal(day), total))
+			elif field[0] == 'UPTO':
+				# Runs only count once the UPTO after them was written
+				runs.extend(pending)
+				pending = []
+				upto = date_from_secs(field[1])
+			elif field[0] == 'INVALIDATE':
+				day = date_from_secs(field[1])
+				runs = [r for r in runs if r[0] < day.date()]
+				pending = []
+				if upto != None and day < upto:
+					upto = day
+				invalidated = True
+		if upto == None:
+			return None
+		return runs, upto, invalidated
+
+	def update_rollup(self, runs, new_runs, upto, rewrite, cached_upto):
+		"""Add new_runs to the cache, it has all timers up to upto now.  The
+		cache was read up to cached_upto.  runs is None when only some of
+		the cached runs were read, then the cache is only appended to."""
+		rname = rollup_name(self.fname)
+		with open(rname, "ab+") as f:
+			if fcntl:
+				try:
+					fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except IOError:
+					# Another report is caching the same days
+					return
+			if not rewrite:
+				# Another report may have added to it since it was read
+				lines, complete = read_tail_lines(f, 0, 1)
+				rewrite = lines != ['UPTO\t{}'.format(date_to_secs(cached_upto))]
+			if self.verbose:
+				print "Caching", len(new_runs), "days in", rname
+			if rewrite and runs == None:
+				if self.verbose:
+					print "Not caching, only some days of", rname, "were read"
+				return
+			if rewrite:
+				with replacing(rname) as new:
+					new.write(rollup_header(self.tag_char, self.fname))
+					write_runs(new, runs + new_runs, upto)
+			else:
+				f.seek(0, 2)
+				write_runs(f, new_runs, upto)
+
+	def invalidate_rollup(self):
+		"""Drop the cached days from the earliest changed timer on.  Timers of
+		today are never cached."""
+		today = datetime.datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+		rname = rollup_name(self.fname)
+		if self.changed_since < today and os.path.exists(rname):
+			day = self.changed_since.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+			if self.verbose:
+				print "Invalidating", rname, "from", day
+			with open(rname, "ab") as f:
+				f.write('INVALIDATE\t{}\n'.format(date_to_secs(day)))
+
+	def check_rollup(self):
+		"""Return whether the rollup cache has the totals of the timers, and
+		remove it when it doesn't"""
+		rname = rollup_name(self.fname)
+		if not os.path.exists(rname):
+			return True
+		rollup = self.read_rollup()
+		if rollup != None:
+			runs, upto, invalidated = rollup
+			if runs == day_runs(select_range(self.timers, None, upto)):
+				return True
+		remove_rollup(self.fname)
+		return False
+
+	@profiled("aggregate", lambda runs, *args: len(runs))
+	def report_runs(self, since = None, until = None, with_archive = False, filter = None):
+		"""Return the totals of each day that timers started on, from since
+		up to until, as a list of (date, (name totals, tag totals)).  Closed
+		days come from the rollup cache, only the timers after it are loaded
+		and added to the cache.  With since only the cached days from since
+		on are read, and only the timers from since on are loaded when the
+		cache ends before since.  Archived timers are only included with
+		with_archive or since.  With a TimerFilter only the timers that
+		match it are added up."""
+		if filter != None:
+			# The cache only has the totals of all timers of a day
+			if self.jobs < 2:
+				return day_runs(list(self.iter_timers(since, until, with_archive, filter)))
+			runs = []
+			if with_archive or since:
+				runs = self.archive_runs(since, until, filter)
+			self.require(since)
+			return join_runs(runs, parallel_day_runs(self.select(since, until, filter), self.jobs))
+		fname = self.fname
+		runs = []
+		if os.path.exists(fname):
+			cached = []
+			upto = None
+			invalidated = True
+			rollup = self.read_rollup(since, until)
+			if rollup != None:
+				cached, upto, invalidated = rollup
+			if since and (upto == None or upto <= since):
+				# None of the days are cached, and caching the days before
+				# since would load all timers
+				self.require(since)
+				runs = parallel_day_runs(select_range(self.timers, since, until), self.jobs)
+			else:
+				self.require(upto)
+				live = select_range(self.timers, upto, None)
+				live_runs = parallel_day_runs(live, self.jobs)
+				runs = cached + live_runs
+				# The cache only works for timers in order
+				if in_order(live):
+					final = final_day(live)
+					if upto == None or upto < final:
+						new_runs = [r for r in live_runs if r[0] < final.date()]
+						if since or until:
+							cached = None
+						self.update_rollup(cached, new_runs, final, invalidated, upto)
+				elif self.verbose:
+					print "Not caching timers that are out of order"
+		if since:
+			runs = [r for r in runs if r[0] >= since.date()]
+		if until:
+			runs = [r for r in runs if r[0] < until.date()]
+		# Archived timers are older than the timers in the file.
+		if with_archive or since:
+			runs = self.archive_runs(since, until) + runs
+		return runs
+
+	def archive_runs(self, since = None, until = None, filter = None):
+		"""Return the day runs of the archived timers from since up to until
+		that match filter.  With jobs a pool of processes adds up a segment
+		each."""
+		segments = archived_segments(self.fname, since, until)
+		if self.jobs < 2 or len(segments) < 2:
+			timers = self.load_archive(since, until)
+			if filter != None:
+				timers = [t for t in timers if filter.match(t)]
+			return day_runs(timers)
+		import multiprocessing
+		pool = multiprocessing.Pool(min(self.jobs, len(segments)))
+		try:
+			run_lists = pool.map(segment_runs, [(self.fname, month, self.tag_char, since, until, filter)
+												for month in segments])
+		finally:
+			pool.close()
+		# Days don't cross segments, they are months
+		return list(itertools.chain(*run_lists))
+
+	def iter_timers(self, since = None, until = None, with_archive = False, filter = None):
+		"""Yield the timers that started from since up to until and match
+		filter, oldest first.  Archived timers are only included with
+		with_archive or since, they are read one segment at a time."""
+		if with_archive or since:
+			for t in self.iter_archive(since, until):
+				if filter == None or filter.match(t):
+					yield t
+		self.require(since)
+		for t in self.select(since, until, filter):
+			yield t
+
+	def iter_archive(self, since = None, until = None):
+		"""Yield the archived timers that started from since up to until,
+		reading one segment at a time"""
+		for month in archived_segments(self.fname, since, until):
+			for t in select_range(self.load_segment(month), since, until):
+				yield t
+
+	def stream(self, since = None, until = None, with_archive = False, filter = None):
+		"""Yield the timers that started from since up to until and match
+		filter like iter_timers(), but read them from the file one at a time
+		instead of loading it.  Only the last timers, which the journal may
+		change, are kept until the end of the file."""
+		if self.loaded_state != None or not os.path.exists(self.fname):
+			for t in self.iter_timers(since, until, with_archive, filter):
+				yield t
+			return
+		if with_archive or since:
+			for t in self.iter_archive(since, until):
+				if filter == None or filter.match(t):
+					yield t
+		depth = journal_depth(journal_name(self.fname))
+		tail = collections.deque()
+		with open(self.fname, "rb") as f:
+			load_version, offset = self.load_header(f)
+			f.seek(offset)
+			for line in f:
+				field = line.rstrip('\r\n').split('\t')
+				if field[0] != 'TIMER':
+					self.load_setting(field)
+					continue
+				tail.append(timer_from_fields(field, load_version, self.tag_char))
+				if len(tail) > depth:
+					t = tail.popleft()
+					if in_range(t.start, since, until) and (filter == None or filter.match(t)):
+						yield t
+		self.timers = list(tail)
+		self.timers_complete = False
+		self.replay_journal()
+		for t in select_range(self.timers, since, until):
+			if filter == None or filter.match(t):
+				yield t
+
+	def select(self, since = None, until = None, filter = None):
+		"""Return the timers in memory that started from since up to until
+		and match filter"""
+		timers = self.timers
+		lo, hi = range_bounds(timers, since, until)
+		if filter == None:
+			return timers[lo:hi]
+		if not self.resident:
+			# Building the index takes longer than matching the timers once,
+			# it only pays off when the next reports reuse it
+			return [t for t in itertools.islice(timers, lo, hi) if filter.match(t)]
+		if self.timer_index == None:
+			self.timer_index = TimerIndex()
+		self.timer_index.update(timers)
+		return [timers[i] for i in filter.positions(self.timer_index, lo, hi)]
+
+	def changed(self, date):
+		if self.changed_since == None or date < self.changed_since:
+			self.changed_since = date
+
+	def active(self):
+		"""Return the active timer, or None"""
+		if self.timers and self.timers[-1].active():
+			return self.timers[-1]
+		return None
+
+	def stop(self, now = None):
+		"""Stop the active timer at now, and move timers that ended after now
+		back to it, e.g. for --leap.  Return a list of (timer, start, end) of
+		the timers that changed, with their start and end before."""
+		if now == None:
+			now = datetime.datetime.now().replace(microsecond=0)
+		self.require_tail()
+		# The loop below stops at the first timer that ended before now, so it
+		# has to be in the loaded timers.
+		if not self.timers_complete and not [t for t in self.timers if t.end and t.start <= now and t.end <= now]:
+			self.load_all()
+		timers = self.timers
+		changes = []
+		for i in xrange(len(timers)-1, -1, -1):
+			t = timers[i]
+			if now < t.start:
+				start = now
+			elif t.active() or now < t.end:
+				start = t.start
+			else:
+				break
+			changes.append((t, t.start, t.end))
+			self.adjust(i, start, now)
+		return changes
+
+	def adjust(self, index, start, end):
+		"""Move timers[index] to start and end.  A negative index counts from
+		the end as usual."""
+		self.require_tail()
+		timers = self.timers
+		if index < 0:
+			index += len(timers)
+		t = timers[index]
+		self.changed(min(t.start, start))
+		record = str(index - len(timers))
+		if t.active() and end != None and start == t.start:
+			t.end = end
+			self.journal_event('STOP', record, date_to_field(end))
+		else:
+			t.start = start
+			t.end = end
+			self.journal_event('ADJUST', record, date_to_field(start), date_to_field(end))
+
+	def insert(self, name, comment, start, end, now = None):
+		"""Insert a timer from start to end among the others, found by
+		bisecting them.  A timer that runs at start is cut off there and
+		continues at end, later timers that start before end are moved to
+		end, and the ones that end before end too are removed.  Return the
+		inserted timers, the changes like stop() does and the removed
+		timers."""
+		if now == None:
+			now = datetime.datetime.now().replace(microsecond=0)
+		if end > now:
+			raise ValueError("Can't insert a timer that ends after now")
+		segments = read_manifest(self.fname)
+		if segments and start <= max([s[3] for s in segments]):
+			raise ValueError("Can't insert a timer before the archived timers")
+		self.require(start)
+		if self.name_index == None:
+			# To rank the names by the position of the timers
+			self.load_name_index()
+		timers = self.timers
+		i = find_start(timers, start)
+		changes = []
+		inserted = []
+		removed = []
+		rest = None
+		if i > 0:
+			t = timers[i-1]
+			if t.active() or t.end > start:
+				changes.append((t, t.start, t.end))
+				if t.active() or t.end > end:
+					# It continues after the inserted timer
+					rest = (t.name, t.comment, end, t.end)
+				self.adjust(i - 1, t.start, start)
+		inserted.append(self.insert_timer(i, name, comment, start, end))
+		i += 1
+		if rest:
+			inserted.append(self.insert_timer(i, *rest))
+			i += 1
+		while i < len(timers) and timers[i].start < end:
+			t = timers[i]
+			if t.active() or t.end > end:
+				changes.append((t, t.start, t.end))
+				self.adjust(i, end, t.end)
+				break
+			removed.append(t)
+			self.delete(i)
+		return inserted, changes, removed
+
+	def insert_timer(self, index, name, comment, start, end):
+		self.require_tail()
+		timers = self.timers
+		t = Timer(name, comment, start, end, self.tag_char)
+		self.journal_event('INSERT', str(index - len(timers)), date_to_field(start), date_to_field(end), t.name, t.comment)
+		timers.insert(index, t)
+		self.timer_index = None
+		self.changed(start)
+		# Ranked by where it is, not as the most recent name
+		last = None
+		if self.name_index != None:
+			last = self.name_index.count - (len(timers) - 1 - index)
+			self.name_index.add(t.name, 1, last)
+		self.new_names.append((t.name, last))
+		return t
+
+	def delete(self, index):
+		"""Remove timers[index].  A negative index counts from the end as
+		usual."""
+		self.require_tail()
+		timers = self.timers
+		if index < 0:
+			index += len(timers)
+		self.changed(timers[index].start)
+		self.journal_event('DELETE', str(index - len(timers)))
+		del timers[index]
+		self.timer_index = None
+
+	def start(self, name, comment = "", now = None):
+		"""Start a timer at now and return it.  Stop the active timer first,
+		only one timer runs at a time."""
+		if now == None:
+			now = datetime.datetime.now().replace(microsecond=0)
+		self.require_tail()
+		if self.active():
+			self.stop(now)
+		t = Timer(name, comment, now, None, self.tag_char)
+		self.timers.append(t)
+		self.changed(now)
+		self.journal_event('START', date_to_field(now), t.name, t.comment)
+		self.new_names.append((t.name, None))
+		if self.name_index != None:
+			self.name_index.add(t.name)
+		return t
+
+# The timers, their tags for filtering by tag, and the settings of the data
+# file as (key, tab separated fields)
+sqlite_schema = """
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS timers (id INTEGER PRIMARY KEY, start INTEGER NOT NULL,
+	stop INTEGER, name TEXT NOT NULL, comment TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tags (timer INTEGER NOT NULL, tag TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS timers_start ON timers (start);
+CREATE INDEX IF NOT EXISTS timers_name ON timers (name, start);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag, timer);
+CREATE INDEX IF NOT EXISTS tags_timer ON tags (timer);
+"""
+sqlite_suffixes = (".sqlite", ".sqlite3", ".db")
+epoch_day = datetime.date(1970, 1, 1).toordinal()
+
+def is_sqlite(fname):
+	"""Return whether fname is a SQLite database, or will be one when it
+	doesn't exist yet"""
+	if os.path.exists(fname) and os.path.getsize(fname):
+		with open(fname, "rb") as f:
+			return f.read(16) == "SQLite format 3\0"
+	return fname.endswith(sqlite_suffixes)
+
+def open_tracker(fname = "~/.timetracker", verbose = False):
+	"""Return the TimeTracker for the storage of fname"""
+	if is_sqlite(os.path.expanduser(fname)):
+		return SqliteTracker(fname, verbose)
+	return TimeTracker(fname, verbose)
+
+def seconds_from_field(field):
+	if field == 'None':
+		return None
+	return int(field)
+
+class SqliteTracker(TimeTracker):
+	"""The timers of a SQLite database.  Changes are written to it as they
+	are made, in a transaction that commit() commits, and reports are added
+	up by SQLite, so only the timers a command works on are loaded."""
+
+	def __init__(self, fname = "~/.timetracker.sqlite", verbose = False):
+		TimeTracker.__init__(self, fname, verbose)
+		self.db = None
+		# The row ids of timers
+		self.ids = []
+		# Whether the transaction has changes
+		self.pending = False
+
+	def connect(self):
+		"""Open the database, creating it when it doesn't exist yet"""
+		if self.db == None:
+			import sqlite3
+			if self.verbose:
+				print "opening", self.fname
+			self.db = sqlite3.connect(self.fname)
+			self.db.text_factory = str
+			self.db.executescript(sqlite_schema)
+			tags = None
+			for key, value in self.db.execute("SELECT key, value FROM settings"):
+				if key == 'TAGS':
+					tags = value
+				else:
+					self.load_setting([key] + value.split('\t'))
+			# Tags depend on the tag character
+			if tags != self.tag_char:
+				self.update_tags()
+				self.db.commit()
+		return self.db
+
+	def update_tags(self):
+		if self.verbose:
+			print "Finding the tags of all timers with", self.tag_char
+		db = self.db
+		db.execute("DELETE FROM tags")
+		rows = db.execute("SELECT id, name, comment FROM timers").fetchall()
+		db.executemany("INSERT INTO tags VALUES (?, ?)",
+				[(i, tag) for i, name, comment in rows for tag in shared_name(name, comment, self.tag_char)[2]])
+		db.execute("INSERT OR REPLACE INTO settings VALUES ('TAGS', ?)", (self.tag_char,))
+
+	def clear(self):
+		TimeTracker.clear(self)
+		self.ids = []
+
+	def forget_changes(self):
+		TimeTracker.forget_changes(self)
+		if self.pending:
+			# The timers in memory have changes the database won't have
+			self.db.rollback()
+			self.pending = False
+			self.load()
+
+	def load_rows(self, rows):
+		tag_char = self.tag_char
+		self.timers = []
+		self.ids = []
+		append = self.timers.append
+		for i, start, stop, name, comment in rows:
+			if stop != None:
+				stop = date_from_seconds(stop)
+			append(Timer(name, comment, date_from_seconds(start), stop, tag_char))
+			self.ids.append(i)
+		self.name_index = None
+		self.timer_index = None
+		self.loaded_state = file_state(self.fname)
+		if self.verbose:
+			print "loaded", len(self.timers), "timers"
+
+	@profiled("load", lambda result, self: len(self.timers))
+	def load(self):
+		"""Load all timers"""
+		db = self.connect()
+		self.load_rows(db.execute("SELECT id, start, stop, name, comment FROM timers ORDER BY start, id"))
+		self.timers_complete = True
+
+	@profiled("load", lambda result, self, *args: len(self.timers))
+	def load_tail(self, count):
+		"""Load only the last count timers"""
+		db = self.connect()
+		rows = db.execute("SELECT id, start, stop, name, comment FROM timers ORDER BY start DESC, id DESC LIMIT ?",
+				(count,)).fetchall()
+		rows.reverse()
+		self.load_rows(rows)
+		self.timers_complete = len(rows) < count
+		return True
+
+	def load_since(self, since):
+		"""Load the timers that started on or after since, and the one before"""
+		db = self.connect()
+		since = int(date_to_secs(since))
+		before = db.execute("SELECT max(start) FROM timers WHERE start < ?", (since,)).fetchone()[0]
+		if before == None:
+			self.load()
+		else:
+			self.load_rows(db.execute("SELECT id, start, stop, name, comment FROM timers WHERE start >= ? ORDER BY start, id",
+					(before,)))
+			self.timers_complete = False
+		return True
+
+	def reload(self):
+		"""Load all timers again, the changes that were not committed are
+		already in the database"""
+		if os.path.exists(self.fname):
+			self.load()
+		else:
+			self.clear()
+
+	def journal_event(self, *field):
+		"""Write a change, as a journal record, to the database"""
+		db = self.connect()
+		ids = self.ids
+		if field[0] == 'START':
+			ids.append(self.insert_row(field[1], 'None', field[2], field[3]))
+		elif field[0] == 'INSERT':
+			ids.insert(len(ids) + int(field[1]), self.insert_row(*field[2:]))
+		elif field[0] == 'DELETE':
+			i = ids.pop(len(ids) + int(field[1]))
+			db.execute("DELETE FROM tags WHERE timer = ?", (i,))
+			db.execute("DELETE FROM timers WHERE id = ?", (i,))
+		else:
+			i = ids[len(ids) + int(field[1])]
+			if field[0] == 'STOP':
+				db.execute("UPDATE timers SET stop = ? WHERE id = ?", (seconds_from_field(field[2]), i))
+			elif field[0] == 'ADJUST':
+				db.execute("UPDATE timers SET start = ?, stop = ? WHERE id = ?",
+						(seconds_from_field(field[2]), seconds_from_field(field[3]), i))
+		self.pending = True
+
+	def insert_row(self, start, stop, name, comment):
+		"""Insert a timer with its tags and return its row id"""
+		db = self.db
+		i = db.execute("INSERT INTO timers (start, stop, name, comment) VALUES (?, ?, ?, ?)",
+				(seconds_from_field(start), seconds_from_field(stop), name, comment)).lastrowid
+		db.executemany("INSERT INTO tags VALUES (?, ?)",
+				[(i, tag) for tag in shared_name(name, comment, self.tag_char)[2]])
+		return i
+
+	@profiled("save", lambda result, self: len(self.timers))
+	def save(self):
+		"""Replace all timers and settings in the database"""
+		db = self.connect()
+		if self.verbose:
+			print "Saving", self.fname
+		db.commit()
+		if self.loaded_state != None:
+			backup(self.fname, self.verbose)
+		db.execute("DELETE FROM timers")
+		db.execute("DELETE FROM tags")
+		db.execute("DELETE FROM settings")
+		db.execute("INSERT INTO settings VALUES ('TAGS', ?)", (self.tag_char,))
+		if self.tag_char != default_tag_char:
+			db.execute("INSERT INTO settings VALUES ('TAGCHAR', ?)", (self.tag_char,))
+		if self.font_name != default_font_name or self.font_size != default_font_size:
+			db.execute("INSERT INTO settings VALUES ('FONT', ?)", ('{}\t{}'.format(self.font_name, self.font_size),))
+		self.ids = [self.insert_row(date_to_secs(t.start), date_to_secs(t.end), t.name, t.comment) for t in self.timers]
+		db.commit()
+		if self.verbose:
+			print "saved", len(self.timers), "timers"
+		self.pending = False
+		self.save_changes = False
+		self.journal_events = []
+		self.new_names = []
+		self.loaded_state = file_state(self.fname)
+
+	def commit(self, compact = False):
+		"""Commit the changes, and with compact let SQLite compact the
+		database"""
+		if self.db == None:
+			return
+		self.db.commit()
+		if compact:
+			self.db.execute("VACUUM")
+		self.pending = False
+		self.save_changes = False
+		self.new_names = []
+		self.loaded_state = file_state(self.fname)
+
+	def complete(self, prefix):
+		if self.name_index == None:
+			self.load_name_index()
+		return self.name_index.complete(prefix, self.tag_char)
+
+	@profiled("names")
+	def load_name_index(self):
+		"""Build the name index from the names in the database, with their
+		uses and the number of their last timer"""
+		import sqlite3
+		self.name_index = NameIndex()
+		if not os.path.exists(self.fname):
+			return
+		db = self.connect()
+		try:
+			rows = db.execute("SELECT name, count(*), max(n) AS last FROM"
+					" (SELECT name, row_number() OVER (ORDER BY start, id) AS n FROM timers)"
+					" GROUP BY name ORDER BY last").fetchall()
+		except sqlite3.OperationalError:
+			# SQLite before 3.25 has no row_number()
+			for (name,) in db.execute("SELECT name FROM timers ORDER BY start, id"):
+				self.name_index.add(name)
+			return
+		for name, uses, last in rows:
+			self.name_index.add(name, uses, last)
+
+	def save_name_index(self):
+		pass
+
+	def append_name_index(self):
+		self.new_names = []
+
+	def archive(self, before):
+		print "Timers in a SQLite database are not archived, the index on their start finds them"
+
+	def range_where(self, since, until):
+		"""Return the WHERE clause and its arguments for timers that started
+		from since up to until"""
+		where = []
+		args = []
+		if since:
+			where.append("start >= ?")
+			args.append(int(date_to_secs(since)))
+		if until:
+			where.append("start < ?")
+			args.append(int(date_to_secs(until)))
+		return where, args
+
+	@profiled("aggregate", lambda runs, *args: len(runs))
+	def report_runs(self, since = None, until = None, with_archive = False, filter = None):
+		"""Return the totals of each day that timers started on, like
+		TimeTracker.report_runs(), added up by SQLite"""
+		if filter != None:
+			return day_runs(list(self.iter_timers(since, until, with_archive, filter)))
+		if not os.path.exists(self.fname):
+			return []
+		db = self.connect()
+		where, args = self.range_where(since, until)
+		if where:
+			where = " WHERE " + " AND ".join(where)
+		else:
+			where = ""
+		# Active timers count up to now
+		now = int(date_to_secs(datetime.datetime.now().replace(microsecond=0)))
+		days = {}
+		# Division rounds toward zero in SQLite, the days before 1970 need
+		# the floor
+		day_column = "(start - ((start % 86400) + 86400) % 86400) / 86400 AS day"
+		for day, name, seconds in db.execute("SELECT " + day_column + ", name, sum(coalesce(stop, ?) - start)"
+				" FROM timers" + where + " GROUP BY day, name", [now] + args):
+			days.setdefault(day, ({}, {}))[0][name] = datetime.timedelta(seconds = seconds)
+		for day, tag, seconds in db.execute("SELECT " + day_column + ", tag, sum(coalesce(stop, ?) - start)"
+				" FROM timers JOIN tags ON tags.timer = timers.id" + where + " GROUP BY day, tag", [now] + args):
+			days.setdefault(day, ({}, {}))[1][tag] = datetime.timedelta(seconds = seconds)
+		return [(datetime.date.fromordinal(day + epoch_day), days[day]) for day in sorted(days)]
+
+	def iter_timers(self, since = None, until = None, with_archive = False, filter = None):
+		"""Yield the timers that started from since up to until and match
+		filter, oldest first, from the database.  The tags of filter are
+		looked up in the index of tags."""
+		if not os.path.exists(self.fname):
+			return
+		db = self.connect()
+		where, args = self.range_where(since, until)
+		if filter != None:
+			for group in filter.groups:
+				one_of = []
+				for negated, tag in group:
+					if negated:
+						one_of.append("id NOT IN (SELECT timer FROM tags WHERE tag = ?)")
+					else:
+						one_of.append("id IN (SELECT timer FROM tags WHERE tag = ?)")
+					args.append(tag)
+				where.append("(" + " OR ".join(one_of) + ")")
+		if where:
+			where = " WHERE " + " AND ".join(where)
+		else:
+			where = ""
+		tag_char = self.tag_char
+		for start, stop, name, comment in db.execute("SELECT start, stop, name, comment FROM timers"
+				+ where + " ORDER BY start, id", args):
+			if stop != None:
+				stop = date_from_seconds(stop)
+			t = Timer(name, comment, date_from_seconds(start), stop, tag_char)
+			# Names are matched here
+			if filter == None or filter.match(t):
+				yield t
+
+	def stream(self, since = None, until = None, with_archive = False, filter = None):
+		return self.iter_timers(since, until, with_archive, filter)
+
+def convert(tracker, fname):
+	"""Copy all timers of tracker, the archived ones too, and its settings to
+	the new data file fname, in the storage open_tracker() picks for it"""
+	if os.path.exists(fname):
+		print fname, "exists already"
+		sys.exit(1)
+	dest = open_tracker(fname, tracker.verbose)
+	with dest.locked():
+		tracker.load_all()
+		dest.timers = tracker.load_archive() + tracker.timers
+		dest.tag_char = tracker.tag_char
+		dest.font_name = tracker.font_name
+		dest.font_size = tracker.font_size
+		dest.save()
+	print "Copied", len(dest.timers), "timers to", fname
+
+def data_files(specs, label_files = False):
+	"""Return (label, file name) of each data file of the -f options, with
+	globs expanded.  A spec is FILE or LABEL=FILE."""
+	files = []
+	for spec in specs or ["~/.timetracker"]:
+		label = None
+		if "=" in spec and not os.path.exists(os.path.expanduser(spec)):
+			label, spec = spec.split("=", 1)
+		fname = os.path.expanduser(spec)
+		if glob.has_magic(fname):
+			names = sorted(glob.glob(fname))
+			if not names:
+				parser.error("no data files match " + spec)
+		else:
+			names = [fname]
+		for fname in names:
+			if label == None and label_files:
+				files.append((os.path.splitext(os.path.basename(fname))[0].lstrip("."), fname))
+			else:
+				files.append((label, fname))
+	return files
+
+def labeled_timers(tracker, label, since, until, with_archive):
+	"""Yield the timers of tracker.stream() with the tag label added"""
+	labeled = {}
+	for t in tracker.stream(since, until, with_archive):
+		if label:
+			tags = labeled.get(t.tags)
+			if tags == None:
+				tags = t.tags | frozenset([tracker.tag_char + label])
+				labeled[t.tags] = tags
+			t.tags = tags
+		yield t
+
+def file_runs(args):
+	"""Return the day runs of one file of a TrackerGroup, for a worker
+	process"""
+	label, fname, since, until, with_archive, filter = args
+	timers = labeled_timers(open_tracker(fname), label, since, until, with_archive)
+	if filter != None:
+		timers = itertools.ifilter(filter.match, timers)
+	return day_runs(timers)
+
+def merge_runs(run_lists):
+	"""Merge the day runs of several files, adding up the totals of the days
+	they have in common"""
+	runs = []
+	keyed = [[(date, i, total) for date, total in r] for i, r in enumerate(run_lists)]
+	for date, i, total in heapq.merge(*keyed):
+		if runs and runs[-1][0] == date:
+			add_totals(total, runs[-1][1])
+		else:
+			runs.append((date, total))
+	return runs
+
+class TrackerGroup(object):
+	"""The timers of several data files for reports.  The files are read one
+	timer at a time and merged by start, so memory depends on the number of
+	files and not on the number of timers.  Each file can have a label that
+	is added to the tags of its timers."""
+
+	def __init__(self, sources, jobs = 1):
+		# (label, tracker) of each file
+		self.sources = sources
+		self.jobs = jobs
+		self.fname = sources[0][1].fname
+		# main() doesn't load anything first, reports read the files
+		self.resident = True
+
+	def iter_timers(self, since = None, until = None, with_archive = False, filter = None):
+		"""Yield the timers of all files oldest first, like
+		TimeTracker.iter_timers()"""
+		# The index of the file and of the timer in it decide between timers
+		# that started at the same time.
+		def keyed(i, tracker, label):
+			for n, t in enumerate(labeled_timers(tracker, label, since, until, with_archive)):
+				yield t.start, i, n, t
+		streams = [keyed(i, tracker, label) for i, (label, tracker) in enumerate(self.sources)]
+		for start, i, n, t in heapq.merge(*streams):
+			if filter == None or filter.match(t):
+				yield t
+
+	# The files are always streamed
+	stream = iter_timers
+
+	@profiled("aggregate", lambda runs, *args: len(runs))
+	def report_runs(self, since = None, until = None, with_archive = False, filter = None):
+		"""Return the day runs of all files, like TimeTracker.report_runs().
+		With more than one job each file is added up by a worker process and
+		their runs are merged."""
+		if self.jobs > 1 and len(self.sources) > 1:
+			import multiprocessing
+			pool = multiprocessing.Pool(min(self.jobs, len(self.sources)))
+			try:
+				run_lists = pool.map(file_runs, [(label, tracker.fname, since, until, with_archive, filter)
+												 for label, tracker in self.sources])
+			finally:
+				pool.close()
+			return merge_runs(run_lists)
+		return day_runs(self.iter_timers(since, until, with_archive, filter))
+
+	def commit(self, compact = False):
+		pass
 
-def start_timer(name, comment):
-	global save_changes, timers
-	timers.append(Timer(name, comment, now))
-	save_changes = True
-	print "Start:", name, now
 
 def same_day(prev_date, date):
 	return prev_date.toordinal() == date.toordinal()
@@ -415,46 +3342,41 @@ def print_monthly(date, total):
 	print 'month {:%Y-%m}'.format(date)
 	print_durations(total)
 
-def report():
-	if len(timers) == 0:
+def add_totals(total, sum):
+	for i in (0, 1):
+		for n, d in total[i].iteritems():
+			if n in sum[i]:
+				sum[i][n] += d
+			else:
+				sum[i][n] = d
+
+def report(runs):
+	if len(runs) == 0:
 		print "No timers to report"
 		return
-	prev_date = timers[0].start
-	daily_total = ({}, {})
 	weekly_total = ({}, {})
 	monthly_total = ({}, {})
-	for t in timers:
-		date = t.start
-		if not same_day(prev_date, date):
-			print_daily(prev_date, daily_total)
-			daily_total = ({}, {})
-		if not same_week(prev_date, date):
-			print_weekly(prev_date, weekly_total)
+	for i in xrange(len(runs)):
+		date, daily_total = runs[i]
+		print_daily(date, daily_total)
+		add_totals(daily_total, weekly_total)
+		add_totals(daily_total, monthly_total)
+		last = i + 1 == len(runs)
+		if last or not same_week(date, runs[i+1][0]):
+			print_weekly(date, weekly_total)
 			weekly_total = ({}, {})
-		if not same_month(prev_date, date):
-			print_monthly(prev_date, monthly_total)
+		if last or not same_month(date, runs[i+1][0]):
+			print_monthly(date, monthly_total)
 			monthly_total = ({}, {})
-		add_duration(t, monthly_total)
-		add_duration(t, weekly_total)
-		add_duration(t, daily_total)
-		prev_date = date
-	print_daily(prev_date, daily_total)
-	print_weekly(prev_date, weekly_total)
-	print_monthly(prev_date, monthly_total)
 
-def add_duration_week(timer, total):
-	day = timer.start.weekday()
-	n = timer.name
-	d = timer.duration()
-	if n not in total[0]:
-		total[0][n] = [ datetime.timedelta(0) ] * 8
-	total[0][n][day] += d
-	total[0][n][7] += d
-	for t in timer.tags:
-		if t not in total[1]:
-			total[1][t] = [ datetime.timedelta(0) ] * 8
-		total[1][t][day] += d
-		total[1][t][7] += d
+def add_totals_week(date, total, sum):
+	day = date.weekday()
+	for i in (0, 1):
+		for n, d in total[i].iteritems():
+			if n not in sum[i]:
+				sum[i][n] = [ datetime.timedelta(0) ] * 8
+			sum[i][n][day] += d
+			sum[i][n][7] += d
 
 def print_durations_week(total):
 	# TODO: format the name at the end of a line to fit the terminal width.
@@ -498,16 +3420,15 @@ def print_weekly_cal(date, total):
 	print line2, "Total  Name"
 	print_durations_week(total)
 
-def report_cal():
-	if len(timers) == 0:
+def report_cal(runs):
+	if len(runs) == 0:
 		print "No timers to report"
 		return
 	print "=" * 78
-	prev_date = timers[0].start
+	prev_date = runs[0][0]
 	weekly_total = ({}, {})
 	monthly_total = ({}, {})
-	for t in timers:
-		date = t.start
+	for date, total in runs:
 		if not same_month(prev_date, date):
 			print_weekly_cal(prev_date, weekly_total)
 			print_monthly(prev_date, monthly_total)
@@ -517,27 +3438,118 @@ def report_cal():
 		elif not same_week(prev_date, date):
 			print_weekly_cal(prev_date, weekly_total)
 			weekly_total = ({}, {})
-		add_duration(t, monthly_total)
-		add_duration_week(t, weekly_total)
+		add_totals(total, monthly_total)
+		add_totals_week(date, total, weekly_total)
 		prev_date = date
 	print_weekly_cal(prev_date, weekly_total)
 	print_monthly(prev_date, monthly_total)
 
-def report_break_in_service():
-	prev_date = timers[0].start
-	for t in timers:
-		date = t.start
+def report_break_in_service(runs):
+	if len(runs) == 0:
+		print "No timers to report"
+		return
+	prev_date = runs[0][0]
+	for date, total in runs:
 		start_break = prev_date.toordinal() + 1
 		end_break = date.toordinal() - 1
 		if end_break - start_break + 1 > 3:
 			print '{:%b %d} - {:%b %d}  {:2d} days'.format(datetime.date.fromordinal(start_break), datetime.date.fromordinal(end_break), end_break - start_break + 1)
 		prev_date = date
 
+timer_fields = ["start", "end", "seconds", "name", "comment", "tags"]
+total_fields = ["period", "date", "type", "key", "seconds"]
+
+def timer_records(timers):
+	# Timers with the same name share their tags
+	tag_lists = {}
+	for t in timers:
+		tags = tag_lists.get(t.tags)
+		if tags == None:
+			tags = sorted([tag for tag in t.tags if tag != "No tags"])
+			tag_lists[t.tags] = tags
+		d = t.duration()
+		# isoformat() is the format of date_to_str(), but faster
+		yield (t.start.isoformat(' '), t.end and t.end.isoformat(' '), d.days * 86400 + d.seconds,
+			   t.name, t.comment, tags)
+
+def period_totals(runs, period):
+	"""Yield the date and totals of each day, week or month of runs, added
+	up like report() does"""
+	if period == "day":
+		same = lambda prev_date, date: False
+	elif period == "week":
+		same = same_week
+	else:
+		same = same_month
+	sum = ({}, {})
+	for i in xrange(len(runs)):
+		date, total = runs[i]
+		add_totals(total, sum)
+		if i + 1 == len(runs) or not same(date, runs[i+1][0]):
+			yield date, sum
+			sum = ({}, {})
+
+def total_records(runs, period):
+	for date, total in period_totals(runs, period):
+		if period == "week":
+			# weekday() returns Monday as 0
+			date = datetime.date.fromordinal(date.toordinal()-date.weekday())
+		if period == "month":
+			label = '{:%Y-%m}'.format(date)
+		else:
+			label = '{:%Y-%m-%d}'.format(date)
+		for type, i in (("name", 0), ("tag", 1)):
+			for n in sorted(total[i].keys()):
+				d = total[i][n]
+				yield (period, label, type, n, d.days * 86400 + d.seconds)
+
+def export(records, fields, format, out):
+	"""Write records, tuples of the values of fields, to out as JSON lines
+	or CSV.  Return the number of records."""
+	import StringIO
+	buf = StringIO.StringIO()
+	if format == "csv":
+		import csv
+		writer = csv.writer(buf, lineterminator="\n")
+		writer.writerow(fields)
+		def line(record):
+			# Tags are separated by spaces like in names
+			writer.writerow([" ".join(v) if isinstance(v, list) else v for v in record])
+	else:
+		import json
+		# json.dumps() of each value would be most of the time of an export
+		quote = json.encoder.encode_basestring_ascii
+		encode = {str: quote, unicode: quote, int: str, long: str, type(None): lambda v: "null",
+				  list: lambda v: "[" + ",".join([quote(s) for s in v]) + "]"}
+		keys = [quote(f) + ":" for f in fields]
+		def line(record):
+			buf.write("{" + ",".join([k + encode[v.__class__](v) for k, v in zip(keys, record)]) + "}\n")
+	# Write a block at a time, the records are not kept
+	count = 0
+	try:
+		for r in records:
+			line(r)
+			count += 1
+			if buf.tell() >= 65536:
+				out.write(buf.getvalue())
+				buf.seek(0)
+				buf.truncate()
+		out.write(buf.getvalue())
+		out.flush()
+	except IOError, e:
+		# e.g. piped to head, which has seen enough
+		if e.errno != errno.EPIPE:
+			raise
+	return count
+
 # Looks messy but I kept it in the same file for easy installation
-def gui():
+def gui(tracker):
 	from PySide import QtCore
 	from PySide import QtGui
-	global timers, reportwin
+	global reportwin
+	# Commands work on the timers in memory, they were all loaded by main()
+	tracker.resident = True
+	fname = tracker.fname
 
 	class TextWindow(QtGui.QWidget):
 		def __init__(self, title, text, parent=None):
@@ -545,7 +3557,7 @@ def gui():
 			self.setWindowTitle(title)
 			self.resize(750, 300)
 			self.textedit = QtGui.QTextEdit(self)
-			self.textedit.setFont(QtGui.QFont(font_name, font_size))
+			self.textedit.setFont(QtGui.QFont(tracker.font_name, tracker.font_size))
 			self.textedit.setReadOnly(True)
 			self.textedit.setPlainText(text)
 			vb = QtGui.QVBoxLayout()
@@ -553,6 +3565,8 @@ def gui():
 			self.setLayout(vb)
 		def write(self, txt):
 			self.textedit.insertPlainText(str(txt))
+		def flush(self):
+			pass
 
 	# Display the latest 100 timer names and duration, most recent first.
 	class TimerTableModel(QtCore.QAbstractTableModel):
@@ -562,20 +3576,20 @@ def gui():
 			self.header = header
 			self.create_rows()
 
-		def duration_str(self, timers, none_on_active):
-			duration = datetime.timedelta(0)
-			active = False
+		def timer_row(self, name, timers):
+			"""Return (name, duration, timers, duration of the stopped timers,
+			active timer).  The duration of a row with an active timer is
+			None, data() adds the active timer to the others when shown."""
+			closed = datetime.timedelta(0)
+			active = None
 			for t in timers:
 				if t.active():
-					if none_on_active:
-						return None
-					active = True
-				duration = duration + t.duration()
+					active = t
+				else:
+					closed += t.end - t.start
 			if active:
-				prefix = "+"
-			else:
-				prefix = " "
-			return duration_str(duration, prefix)
+				return (name, None, timers, closed, active)
+			return (name, duration_str(closed, " "), timers, closed, None)
 
 		def description(self, timers):
 			desc = timers[0].name
@@ -587,62 +3601,123 @@ def gui():
 			return desc
 
 		def create_rows(self):
-			self.rows = []
-			l = len(timers)
-			if l == 0:
-				return
-			t = timers[-1]
-			date_row = 0
+			# The days of the timers, most recent first, with the rows for
+			# both modes so switching is quick.
+			self.days = self.create_days(0, 100)
+			self.rows = self.day_rows(self.days)
+
+		def create_days(self, first, limit):
+			"""Return the days of timers[first:], most recent first.  With a
+			limit, stop after the day that goes over limit rows."""
+			timers = tracker.timers
+			days = []
+			rows = 0
+			i = len(timers)
+			while i > first and (limit == None or rows <= limit):
+				j = i - 1
+				while j > first and same_day(timers[j-1].start, timers[j].start):
+					j -= 1
+				day = self.create_day(j, i)
+				days.append(day)
+				rows += 1 + len(day[2])
+				i = j
+			return days
+
+		def create_day(self, first, last):
+			"""Return (first, date row, rows, combined rows) for the timers
+			from first up to last, which all started on the same day"""
+			timers = tracker.timers
+			t = timers[last - 1]
 			if t.end:
 				date_end = "{:%H:%M}".format(t.end)
 			else:
 				date_end = "{:%H:%M}+".format(t.start)
-			self.rows.append(None)
+			date_row = ("{:%Y-%m-%d %H:%M}-{:s}".format(timers[first].start, date_end), "", None, None, None)
+			rows = []
 			combined_timers = {}
-			combined_rows = {}
-			if not self.combined:
-				self.rows.append((t.name, self.duration_str([t], True), [t]))
-			else:
-				combined_timers[t.name] = [t]
-				combined_rows[t.name] = len(self.rows)
-				self.rows.append(None)
-			for i in range(2, l):
-				pt = timers[-i+1]
-				t = timers[-i]
-				if not same_day(pt.start, t.start):
-					self.rows[date_row] = ("{:%Y-%m-%d %H:%M}-{:s}".format(pt.start, date_end), "", None)
-					if len(self.rows) > 100:
-						date_row = None
-						break
-					date_row = len(self.rows)
-					date_end = "{:%H:%M}".format(t.end)
-					self.rows.append(None)
-					if self.combined:
-						for name, r in combined_rows.items():
-							tt = combined_timers[name]
-							n = " " + name
-							if len(tt) > 1:
-								n = "+" + name
-							self.rows[r] = (n, self.duration_str(tt, True), tt)
-					combined_timers = {}
-					combined_rows = {}
-				if not self.combined:
-					self.rows.append((t.name, self.duration_str([t], True), [t]))
-				elif t.name in combined_timers:
+			names = []
+			for i in xrange(last - 1, first - 1, -1):
+				t = timers[i]
+				rows.append(self.timer_row(t.name, [t]))
+				if t.name in combined_timers:
 					combined_timers[t.name].append(t)
 				else:
 					combined_timers[t.name] = [t]
-					combined_rows[t.name] = len(self.rows)
-					self.rows.append(None)
-			if date_row:
-				self.rows[date_row] = ("{:%Y-%m-%d %H:%M}-{:s}".format(timers[-l].start, date_end), "", None)
-			if self.combined:
-				for name, r in combined_rows.items():
-					tt = combined_timers[name]
-					n = " " + name
-					if len(tt) > 1:
-						n = "+" + name
-					self.rows[r] = (n, self.duration_str(tt, True), tt)
+					names.append(t.name)
+			combined_rows = []
+			for name in names:
+				tt = combined_timers[name]
+				n = " " + name
+				if len(tt) > 1:
+					n = "+" + name
+				combined_rows.append(self.timer_row(n, tt))
+			return (first, date_row, rows, combined_rows)
+
+		def day_rows(self, days):
+			rows = []
+			for day in days:
+				rows.append(day[1])
+				if self.combined:
+					rows.extend(day[3])
+				else:
+					rows.extend(day[2])
+			return rows
+
+		def row_key(self, row):
+			# The date of a date row, or the oldest timer of a row
+			if row[2] == None:
+				return row[0][:10]
+			return row[2][-1]
+
+		def timers_changed(self, first):
+			"""Update the rows after timers[first:] changed or were added.
+			Only the days from the one of timers[first] are created again."""
+			n = 0
+			while n < len(self.days) and self.days[n][0] > first:
+				n += 1
+			if n < len(self.days):
+				n += 1
+			if n:
+				first = self.days[n-1][0]
+			days = self.create_days(first, None)
+			old = self.day_rows(self.days[:n])
+			new = self.day_rows(days)
+			self.days[:n] = days
+			# Rows that are the same at the start and the end stay, the
+			# rows in between are inserted or removed.
+			p = 0
+			while p < len(old) and p < len(new) and self.row_key(old[p]) == self.row_key(new[p]):
+				p += 1
+			s = 0
+			while s < len(old) - p and s < len(new) - p and self.row_key(old[-1-s]) == self.row_key(new[-1-s]):
+				s += 1
+			parent = QtCore.QModelIndex()
+			if len(new) > len(old):
+				self.beginInsertRows(parent, p, p + len(new) - len(old) - 1)
+				self.rows[:len(old)] = new
+				self.endInsertRows()
+			elif len(new) < len(old):
+				self.beginRemoveRows(parent, p, p + len(old) - len(new) - 1)
+				self.rows[:len(old)] = new
+				self.endRemoveRows()
+			else:
+				self.rows[:len(old)] = new
+			# Then the rows that show something else now, e.g. a stopped timer
+			shown = old[:p] + [None] * (len(new) - p - s) + old[len(old)-s:]
+			changed = [r for r in xrange(len(new)) if new[r] != shown[r]]
+			if changed:
+				self.dataChanged.emit(self.createIndex(changed[0], 0, None), self.createIndex(changed[-1], 1, None))
+
+		def set_combined(self, combined):
+			self.beginResetModel()
+			self.combined = combined
+			self.rows = self.day_rows(self.days)
+			self.endResetModel()
+
+		def reset(self):
+			self.beginResetModel()
+			self.create_rows()
+			self.endResetModel()
 
 		def rowCount(self, parent):
 			return len(self.rows)
@@ -653,7 +3728,8 @@ def gui():
 		def data(self, index, role):
 			if not index.isValid():
 				return None
-			t = self.rows[index.row()][2]
+			row = self.rows[index.row()]
+			t = row[2]
 			if role == QtCore.Qt.ToolTipRole:
 				if t:
 					return self.description(t)
@@ -661,9 +3737,9 @@ def gui():
 				if not t:
 					return QtGui.QBrush(QtCore.Qt.red)
 			if role == QtCore.Qt.DisplayRole:
-				if index.column() == 1 and not self.rows[index.row()][index.column()] and t:
-					return self.duration_str(t, False)
-				return self.rows[index.row()][index.column()]
+				if index.column() == 1 and row[4]:
+					return duration_str(row[3] + row[4].duration(), "+")
+				return row[index.column()]
 			return None
 
 		def headerData(self, col, orientation, role):
@@ -674,9 +3750,6 @@ def gui():
 		def getTimer(self,row):
 			return self.rows[row][2]
 
-		def on_model_reset(self):
-			self.create_rows()
-
 
 	app = QtGui.QApplication(sys.argv)
 	app.setApplicationName("TimeTracker")
@@ -702,7 +3775,7 @@ def gui():
 	table_model = TimerTableModel(central, ['timer', 'duration'])
 	table_view = QtGui.QTableView()
 	table_view.setModel(table_model)
-	table_view.setFont(QtGui.QFont(font_name, font_size))
+	table_view.setFont(QtGui.QFont(tracker.font_name, tracker.font_size))
 	table_view.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
 	table_view.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
 	table_view.verticalHeader().setVisible(False)
@@ -710,29 +3783,50 @@ def gui():
 	table_view.resizeColumnsToContents()
 	layout.addWidget(table_view)
 
-	# A timer to update duration of an active task.
-	# TODO: only run the timer when there is an active task
+	# A timer to update duration of an active task, it only runs while there
+	# is one.
 	def updateTimer():
-		if timers[-1].active():
-			index0 = table_model.createIndex(0, 1, None)
-			index1 = table_model.createIndex(1, 1, None)
-			table_model.dataChanged.emit(index0, index1)
+		# The active timer is the most recent one, right after its date
+		index = table_model.createIndex(1, 1, None)
+		table_model.dataChanged.emit(index, index)
 	timer = QtCore.QTimer()
 	timer.setInterval(30000) # 30 seconds
 	timer.timeout.connect(updateTimer)
-	timer.start()
+	def start_stop_timer():
+		if tracker.active():
+			if not timer.isActive():
+				timer.start()
+		else:
+			timer.stop()
+	start_stop_timer()
 
 	# Re-call main() with new command line (No -g)
 	def run_command(cmd):
-		global options, optargs, parser, now, save_changes
-		statusbar.showMessage(sys.argv[0] + " " + " ".join(cmd))
-		save_changes = False
-		now = datetime.datetime.now().replace(microsecond=0)
 		(options, optargs) = parser.parse_args(cmd)
 		options.gui = False;
-		table_model.beginResetModel()
-		main()
-		table_model.endResetModel()
+		options.filename = fname
+		tracker.verbose = options.verbose
+		with tracker.locked(writes(options, optargs)):
+			check_files()
+			statusbar.showMessage(sys.argv[0] + " " + " ".join(cmd))
+			tracker.forget_changes()
+			before = tracker.timers
+			count = len(before)
+			main(tracker, options, optargs)
+		timers = tracker.timers
+		changed_since = tracker.changed_since
+		if timers is not before or len(timers) < count:
+			# e.g. archived timers
+			table_model.reset()
+		elif changed_since != None or len(timers) > count:
+			# Stopping a timer changes the last few timers, starting one
+			# adds one.
+			first = count
+			if changed_since != None:
+				while first > 0 and timers[first-1].start >= changed_since:
+					first -= 1
+			table_model.timers_changed(first)
+		start_stop_timer()
 		sb = table_view.verticalScrollBar()
 		if sb:
 			sb.setSliderPosition(0)
@@ -750,13 +3844,46 @@ def gui():
 	action = QtGui.QAction("Start/Run", win)
 	action.triggered.connect(do_run)
 	toolbar.addAction(action)
+	# Apply the records other tt commands appended to the journal, or load
+	# everything again when the data file was rewritten.
+	def check_files():
+		old = tracker.loaded_state
+		new = file_state(fname)
+		if new == old:
+			return
+		if (old != None and new[0] == old[0] and new[1] != None
+				and (old[1] == None or new[1][2] == old[1][2] and new[1][0] >= tracker.journal_offset)):
+			changes = []
+			if tracker.replay_journal(tracker.journal_offset, changes):
+				tracker.loaded_state = new
+				if changes:
+					table_model.timers_changed(min(changes))
+					start_stop_timer()
+				statusbar.showMessage("Updated from " + journal_name(fname))
+				watch()
+				return
+		do_load()
+		watch()
+	def watch():
+		# Files that were replaced or removed are no longer watched.  The
+		# directory tells when the journal is created.
+		watched = watcher.files() + watcher.directories()
+		for path in (fname, journal_name(fname), os.path.dirname(fname) or "."):
+			if path not in watched and os.path.exists(path):
+				watcher.addPath(path)
+	def on_file_changed(path):
+		with tracker.locked(False):
+			check_files()
+	watcher = QtCore.QFileSystemWatcher()
+	watcher.fileChanged.connect(on_file_changed)
+	watcher.directoryChanged.connect(on_file_changed)
+	watch()
+
 	def do_load():
-		global options
-		fname = os.path.expanduser(options.filename)
 		if os.path.exists(fname):
-			table_model.beginResetModel()
-			load(fname)
-			table_model.endResetModel()
+			tracker.load()
+			table_model.reset()
+			start_stop_timer()
 			statusbar.showMessage("Reloaded " + fname)
 		else:
 			statusbar.showMessage("Could not reload " + fname)
@@ -793,14 +3920,11 @@ def gui():
 			entry.setText(tt[0].name)
 			do_run()
 		else:
-			table_model.beginResetModel()
-			table_model.combined = not table_model.combined
-			table_model.endResetModel()
+			table_model.set_combined(not table_model.combined)
 	def on_return_pressed():
 		run_command(entry.displayText().split())
 	table_view.selectionModel().selectionChanged.connect(on_item_changed)
 	table_view.doubleClicked.connect(on_item_double)
-	table_model.modelReset.connect(table_model.on_model_reset)
 	entry.returnPressed.connect(on_return_pressed)
 
 	win.show()
@@ -808,6 +3932,7 @@ def gui():
 	win.raise_()
 	app.exec_()
 
-main()
+if __name__ == "__main__":
+	run()
 
 # vim: tabstop=4:shiftwidth=4:noexpandtab